@@ -1,10 +1,12 @@
 import cv2
 import pyqtgraph as pg
 from PyQt6.QtWidgets import QWidget, QPushButton, QLabel, QSlider,QLCDNumber, QComboBox
+import os
 import time
 
 from models.image import Image, load_image_from_file_name
-from models.match import draw_matching
+from models.match import draw_matching, match_cache
+from models.sift import sift_cache
 from utils.image_loader import open_image, save_matches_image
 
 class MatchController:
@@ -26,6 +28,7 @@ class MatchController:
         threshold2_label: QLabel,
         lower_bound_label: QLabel,
         upper_bound_label: QLabel,
+        num_workers: int = None,
         ):
 
         self.window = window
@@ -44,6 +47,8 @@ class MatchController:
         self.threshold2_label = threshold2_label
         self.lower_bound_label = lower_bound_label
         self.upper_bound_label = upper_bound_label
+        # Matching threads (query row blocks), all cores by default
+        self.num_workers = num_workers or os.cpu_count() or 1
 
         # Initialize app controller state
         self.loaded_image_1: Image = None
@@ -123,10 +128,12 @@ class MatchController:
 
         start_time = time.time()
         result = draw_matching(cv2.transpose(self.loaded_image_1.image_data), cv2.transpose(self.loaded_image_2.image_data),
-                       method, lower_bound, upper_bound)
+                       method, lower_bound, upper_bound, num_workers=self.num_workers)
         end_time = time.time()
 
         computation_time = end_time - start_time
         self.result_image = result # For exporting later
         self.match_lcdNumber.display(computation_time)
+        print("SIFT cache: {hits} hits, {misses} misses".format(**sift_cache.stats()))
+        print("Match cache: {hits} hits, {misses} misses".format(**match_cache.stats()))
         self.result_image_panel.addItem(pg.ImageItem(cv2.transpose(result))) # Transposing for visualization purpose
\ No newline at end of file
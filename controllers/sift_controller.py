@@ -1,9 +1,10 @@
 import cv2
 import pyqtgraph as pg
 from PyQt6.QtWidgets import QWidget, QPushButton, QLCDNumber
+import html
 import time
 from models.image import Image, load_image_from_file_name
-from models.sift import computeKeypointsAndDescriptors
+from models.sift import SIFTProfiler, computeKeypointsAndDescriptors, sift_cache
 from utils.image_loader import open_image, save_image
 
 class SIFTController:
@@ -16,6 +17,7 @@ class SIFTController:
         result_image_panel: QWidget,
         param1_lcdNumber: QLCDNumber,
         apply_btn: QPushButton,
+        show_stage_breakdown: bool = True,
         ):
 
         self.window = window
@@ -25,6 +27,8 @@ class SIFTController:
         self.result_image_panel = result_image_panel
         self.param1_lcdNumber = param1_lcdNumber
         self.apply_btn = apply_btn
+        # per-stage SIFT timings, printed and shown as the tooltip of the LCD
+        self.show_stage_breakdown = show_stage_breakdown
 
         # Initialize app controller state
         self.current_image: Image = None
@@ -70,9 +74,11 @@ class SIFTController:
 
         grayscale_image = cv2.cvtColor(self.current_image.image_data, cv2.COLOR_RGB2GRAY)
 
-        keypoints, descriptors = computeKeypointsAndDescriptors(grayscale_image)  # Pass raw image data
+        # memory tracing would slow SIFT down and skew the displayed time, so only timings and counts are recorded
+        profiler = SIFTProfiler(trace_memory=False) if self.show_stage_breakdown else None
+        keypoints, descriptors = computeKeypointsAndDescriptors(grayscale_image, profiler=profiler)  # Pass raw image data
 
-        image_with_keypoints = cv2.drawKeypoints(self.current_image.image_data, keypoints, None)  # Use raw image data
+        image_with_keypoints = cv2.drawKeypoints(self.current_image.image_data, keypoints.toKeyPoints(), None)  # Use raw image data
 
         end_time = time.time()
 
@@ -82,6 +88,11 @@ class SIFTController:
         self.param1_lcdNumber.display(computation_time)
 
         print("SIFT computation time: {:.2f} seconds".format(computation_time))
+        print("SIFT cache: {hits} hits, {misses} misses".format(**sift_cache.stats()))
+        if profiler is not None:
+            stage_breakdown = profiler.formatReport()
+            print(stage_breakdown)
+            self.param1_lcdNumber.setToolTip("<pre>{}</pre>".format(html.escape(stage_breakdown)))
         self.current_result = image_with_keypoints  # Directly store the result
         self.current_result_image_item = pg.ImageItem(image_with_keypoints)  # Create a new ImageItem
         self.result_image_panel.addItem(self.current_result_image_item)
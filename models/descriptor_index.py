@@ -0,0 +1,379 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from models.match import (as_float_descriptors, exact_scores, match_block_shape, merge_smallest_costs, nearest_neighbors,
+                          prepare_descriptors, smallest_costs)
+
+
+def train_kmeans(samples: np.ndarray, num_clusters: int, max_iterations: int = 20, seed: int = 0, memory_budget: int = 64 * 2 ** 20) -> np.ndarray:
+    """Lloyd's k-means on the rows of samples, returning float32 centers.
+
+    Centers start at distinct random samples; assignments use the blocked matcher (nearest_neighbors), so memory stays
+    within memory_budget bytes however many samples there are. Clusters that lose all their samples are moved to the
+    samples farthest from their centers.
+    """
+    samples = as_float_descriptors(samples)
+    num_clusters = min(num_clusters, len(samples))
+    random_state = np.random.default_rng(seed)
+    centers = samples[random_state.choice(len(samples), num_clusters, replace=False)]
+    labels = None
+    for _ in range(max_iterations):
+        new_labels, distances = nearest_neighbors(samples, centers, "SSD", 1, memory_budget)
+        new_labels, distances = new_labels[:, 0], distances[:, 0]
+        if labels is not None and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=num_clusters)
+        is_filled = counts > 0
+        # per-cluster sums over samples sorted by cluster (much faster than np.add.at)
+        cluster_starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[is_filled]
+        sums = np.add.reduceat(samples[np.argsort(labels, kind="stable")].astype(np.float64), cluster_starts, axis=0)
+        centers[is_filled] = (sums / counts[is_filled, np.newaxis]).astype(np.float32)
+        empty_clusters = np.flatnonzero(~is_filled)
+        if len(empty_clusters):
+            centers[empty_clusters] = samples[np.argsort(-distances, kind="stable")[:len(empty_clusters)]]
+            labels = None
+    return centers
+
+
+class DescriptorIndex:
+    """Prebuilt nearest-neighbour search over one train descriptor set.
+
+    query() returns what models.match.nearest_neighbors returns: (N, k) train indices and SSD distances or NCC scores, best first,
+    so an index can be passed to feature_matching in place of the second descriptor set. Indexes are written with save() and
+    read back with load_index().
+    """
+
+    kind = None
+
+    def __init__(self, method: str = "SSD") -> None:
+        if method not in ("SSD", "NCC"):
+            raise ValueError("method must be 'SSD' or 'NCC'")
+        self.method = method
+        self.descriptors = None
+
+    def __len__(self) -> int:
+        return 0 if self.descriptors is None else len(self.descriptors)
+
+    def build(self, descriptors: np.ndarray) -> "DescriptorIndex":
+        raise NotImplementedError
+
+    def query(self, descriptors: np.ndarray, k: int = 1) -> tuple:
+        raise NotImplementedError
+
+    def save(self, path: str) -> None:
+        """Write the index to one .npz file"""
+        np.savez(path, kind=self.kind, method=self.method, **self._arrays())
+
+    def _arrays(self) -> dict:
+        raise NotImplementedError
+
+    def _vectors(self, descriptors: np.ndarray) -> np.ndarray:
+        # Search vectors: float32 descriptors, z-normalized for NCC. For z-normalized vectors of dimension d,
+        # |a - b|^2 = 2 d (1 - ncc(a, b)), so the nearest vectors in Euclidean distance are the best NCC matches
+        return prepare_descriptors(descriptors, self.method)
+
+    def _rerank(self, descriptors: np.ndarray, vectors: np.ndarray, candidate_ids: np.ndarray, k: int) -> tuple:
+        # The k best of (N, C) candidate train indices (-1 for none) by exact distance to the stored descriptors,
+        # with scores computed as calculate_SSD / calculate_NCC do
+        valid = candidate_ids >= 0
+        candidate_vectors = self._vectors(self.descriptors[candidate_ids[valid]])
+        exact_costs = np.full(candidate_ids.shape, np.inf, dtype=np.float32)
+        exact_costs[valid] = np.sum((np.repeat(vectors, valid.sum(axis=1), axis=0) - candidate_vectors) ** 2, axis=1)
+        order = np.lexsort((np.where(valid, candidate_ids, len(self)), exact_costs))[:, :k]
+        train_indices = np.take_along_axis(candidate_ids, order, axis=1)
+        scores = np.stack([exact_scores(descriptors, self.descriptors, train_indices[:, j], self.method) for j in range(k)], axis=1)
+        return train_indices, scores.reshape(len(vectors), k)
+
+
+class KDTreeIndex(DescriptorIndex):
+    """Exact search with a KD-tree (scipy.spatial.cKDTree).
+
+    eps > 0 trades accuracy for speed: returned neighbours are then within a factor (1 + eps) of the true distances.
+    Returned scores are recomputed from the stored descriptors as calculate_SSD / calculate_NCC do.
+    """
+
+    kind = "kdtree"
+
+    def __init__(self, method: str = "SSD", leafsize: int = 16, eps: float = 0.0) -> None:
+        super().__init__(method)
+        self.leafsize = leafsize
+        self.eps = eps
+        self.tree = None
+
+    def build(self, descriptors: np.ndarray) -> "KDTreeIndex":
+        self.descriptors = np.asarray(descriptors)
+        self.tree = cKDTree(self._vectors(self.descriptors), leafsize=self.leafsize)
+        return self
+
+    def query(self, descriptors: np.ndarray, k: int = 1, eps: float = None) -> tuple:
+        vectors = self._vectors(descriptors)
+        _, train_indices = self.tree.query(vectors, k=k, eps=self.eps if eps is None else eps)
+        train_indices = np.asarray(train_indices).reshape(len(vectors), k)
+        # cKDTree marks missing neighbours (k larger than the train set) with the train set size
+        train_indices[train_indices >= len(self)] = -1
+        scores = np.stack([exact_scores(descriptors, self.descriptors, train_indices[:, j], self.method) for j in range(k)], axis=1)
+        return train_indices, scores.reshape(len(vectors), k)
+
+    def _arrays(self) -> dict:
+        return {"descriptors": self.descriptors, "leafsize": self.leafsize, "eps": self.eps}
+
+    @classmethod
+    def _from_arrays(cls, method: str, arrays) -> "KDTreeIndex":
+        # the tree itself is rebuilt, which is much faster than the searches it serves
+        index = cls(method, int(arrays["leafsize"]), float(arrays["eps"]))
+        return index.build(arrays["descriptors"])
+
+
+class IVFPQIndex(DescriptorIndex):
+    """Approximate search with an inverted file and product quantization (IVF-PQ).
+
+    Train vectors are clustered into num_lists coarse cells; each vector's residual to its cell center is split into
+    num_subquantizers sub-vectors, each stored as the uint8 index of one of 256 sub-centers. A query scans only the
+    num_probes cells nearest to it, with distances looked up from per-query tables. Unless keep_descriptors is False, the
+    rerank_candidates best of those are re-ranked with exact distances on the stored descriptors.
+    Recall rises and speed falls with num_probes and rerank_candidates, which can also be changed per query.
+    """
+
+    kind = "ivfpq"
+    num_codes = 256
+
+    def __init__(self, method: str = "SSD", num_lists: int = 64, num_subquantizers: int = 16, num_probes: int = 8,
+                 rerank_candidates: int = 32, keep_descriptors: bool = True, max_training_samples: int = 50000,
+                 seed: int = 0) -> None:
+        super().__init__(method)
+        self.num_lists = num_lists
+        self.num_subquantizers = num_subquantizers
+        self.num_probes = num_probes
+        self.rerank_candidates = rerank_candidates
+        self.keep_descriptors = keep_descriptors
+        self.max_training_samples = max_training_samples
+        self.seed = seed
+        self.coarse_centers = self.codebooks = self.codes = self.list_offsets = self.ids = None
+        self.num_vectors = 0
+
+    def __len__(self) -> int:
+        return self.num_vectors
+
+    def build(self, descriptors: np.ndarray) -> "IVFPQIndex":
+        vectors = self._vectors(descriptors)
+        if vectors.shape[1] % self.num_subquantizers:
+            raise ValueError("Descriptor size {} is not divisible by num_subquantizers={}".format(vectors.shape[1], self.num_subquantizers))
+        random_state = np.random.default_rng(self.seed)
+        training_rows = np.sort(random_state.choice(len(vectors), min(len(vectors), self.max_training_samples), replace=False))
+        self.coarse_centers = train_kmeans(vectors[training_rows], self.num_lists, seed=self.seed)
+        list_indices = nearest_neighbors(vectors, self.coarse_centers, "SSD")[0][:, 0]
+        residuals = self._subvectors(vectors - self.coarse_centers[list_indices])
+
+        self.codebooks = np.stack([train_kmeans(residuals[training_rows, j], self.num_codes, seed=self.seed)
+                                   for j in range(self.num_subquantizers)])
+        codes = np.stack([nearest_neighbors(residuals[:, j], self.codebooks[j], "SSD")[0][:, 0]
+                          for j in range(self.num_subquantizers)], axis=1).astype(np.uint8)
+
+        # vectors of one list are stored together, in train order
+        self.ids = np.argsort(list_indices, kind="stable")
+        self.codes = codes[self.ids]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(list_indices, minlength=len(self.coarse_centers)))])
+        self.num_vectors = len(vectors)
+        self.descriptors = np.asarray(descriptors) if self.keep_descriptors else None
+        return self
+
+    def query(self, descriptors: np.ndarray, k: int = 1, num_probes: int = None, rerank_candidates: int = None,
+              memory_budget: int = 64 * 2 ** 20) -> tuple:
+        vectors = self._vectors(descriptors)
+        num_probes = min(num_probes or self.num_probes, len(self.coarse_centers))
+        num_candidates = max(k, rerank_candidates or self.rerank_candidates) if self.descriptors is not None else k
+        probed_lists = nearest_neighbors(vectors, self.coarse_centers, "SSD", num_probes)[0]
+
+        candidate_ids = np.full((len(vectors), num_candidates), -1)
+        candidate_costs = np.full((len(vectors), num_candidates), np.inf, dtype=np.float32)
+        for list_index in np.unique(probed_lists).tolist():
+            start, stop = self.list_offsets[list_index], self.list_offsets[list_index + 1]
+            if start == stop:
+                continue
+            query_rows = np.flatnonzero((probed_lists == list_index).any(axis=1))
+            # query rows are scanned in blocks so that the (rows, list size) cost matrix stays within memory_budget
+            block_rows = max(memory_budget // (4 * (stop - start)), 1)
+            for block in range(0, len(query_rows), block_rows):
+                rows = query_rows[block:block + block_rows]
+                costs = self._approximate_costs(vectors[rows] - self.coarse_centers[list_index], self.codes[start:stop])
+                columns, costs = smallest_costs(costs, num_candidates)
+                ids = np.where(columns >= 0, self.ids[start:stop][columns], -1)
+                candidate_ids[rows], candidate_costs[rows] = merge_smallest_costs(candidate_ids[rows], candidate_costs[rows], ids, costs, num_candidates)
+
+        if self.descriptors is None:
+            train_indices = candidate_ids[:, :k]
+            # approximate squared distances to SSD distances, or to NCC scores through |a - b|^2 = 2 d (1 - ncc)
+            squared_distances = np.maximum(candidate_costs[:, :k].astype(np.float64), 0)
+            if self.method == "SSD":
+                scores = np.sqrt(squared_distances)
+            else:
+                scores = np.where(train_indices >= 0, 1 - squared_distances / (2 * vectors.shape[1]), -np.inf)
+            return train_indices, scores
+
+        return self._rerank(descriptors, vectors, candidate_ids, k)
+
+    def _subvectors(self, vectors: np.ndarray) -> np.ndarray:
+        # (N, d) -> (N, num_subquantizers, d / num_subquantizers)
+        return vectors.reshape(len(vectors), self.num_subquantizers, -1)
+
+    def _approximate_costs(self, residuals: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        # Squared distances between query residuals and encoded residuals, summed from per-subquantizer tables
+        # of the distances between each query sub-vector and the 256 sub-centers
+        residuals = self._subvectors(residuals)
+        tables = np.einsum("nmd,mcd->nmc", residuals, self.codebooks)
+        tables *= -2
+        tables += np.einsum("nmd,nmd->nm", residuals, residuals)[:, :, np.newaxis]
+        tables += np.einsum("mcd,mcd->mc", self.codebooks, self.codebooks)[np.newaxis]
+        costs = np.zeros((len(residuals), len(codes)), dtype=np.float32)
+        for j in range(self.num_subquantizers):
+            costs += tables[:, j, codes[:, j]]
+        return costs
+
+    def _arrays(self) -> dict:
+        arrays = {"coarse_centers": self.coarse_centers, "codebooks": self.codebooks, "codes": self.codes,
+                  "list_offsets": self.list_offsets, "ids": self.ids, "num_probes": self.num_probes,
+                  "rerank_candidates": self.rerank_candidates, "seed": self.seed}
+        if self.descriptors is not None:
+            arrays["descriptors"] = self.descriptors
+        return arrays
+
+    @classmethod
+    def _from_arrays(cls, method: str, arrays) -> "IVFPQIndex":
+        index = cls(method, num_lists=len(arrays["coarse_centers"]), num_subquantizers=arrays["codebooks"].shape[0],
+                    num_probes=int(arrays["num_probes"]), rerank_candidates=int(arrays["rerank_candidates"]),
+                    keep_descriptors="descriptors" in arrays, seed=int(arrays["seed"]))
+        for name in ("coarse_centers", "codebooks", "codes", "list_offsets", "ids"):
+            setattr(index, name, arrays[name])
+        index.num_vectors = len(index.codes)
+        index.descriptors = arrays["descriptors"] if "descriptors" in arrays else None
+        return index
+
+
+# Number of set bits of every 16-bit value, for Hamming distances between packed codes
+popcount_table = np.unpackbits(np.arange(2 ** 16, dtype=np.uint16).view(np.uint8)).reshape(-1, 16).sum(axis=1).astype(np.uint8)
+
+
+def train_sketch_projection(vectors: np.ndarray, num_bits: int = 128, projection: str = "itq", num_iterations: int = 50,
+                            seed: int = 0) -> tuple:
+    """Learn the (mean, (d, num_bits) projection) of binary sketches: the bits are the signs of the centered vectors times the projection.
+
+    "random" draws Gaussian random hyperplanes (any num_bits). "itq" (iterative quantization) rotates the top num_bits
+    principal components so that their signs lose as little as possible (num_bits at most the vector size).
+    """
+    vectors = np.asarray(vectors, dtype=np.float64)
+    mean = vectors.mean(axis=0)
+    random_state = np.random.default_rng(seed)
+    if projection == "random":
+        return mean.astype(np.float32), random_state.standard_normal((vectors.shape[1], num_bits)).astype(np.float32)
+    if projection != "itq":
+        raise ValueError("projection must be 'itq' or 'random'")
+    if num_bits > vectors.shape[1]:
+        raise ValueError("ITQ sketches have at most {} bits, use projection='random' for more".format(vectors.shape[1]))
+    centered = vectors - mean
+    principal_axes = np.linalg.svd(centered, full_matrices=False)[2][:num_bits].T
+    projected = centered @ principal_axes
+    rotation = np.linalg.qr(random_state.standard_normal((num_bits, num_bits)))[0]
+    for _ in range(num_iterations):
+        # with the codes fixed, the best rotation is an orthogonal Procrustes solution
+        left, _, right = np.linalg.svd(projected.T @ np.sign(projected @ rotation))
+        rotation = left @ right
+    return mean.astype(np.float32), (principal_axes @ rotation).astype(np.float32)
+
+
+def sketch(vectors: np.ndarray, mean: np.ndarray, projection: np.ndarray) -> np.ndarray:
+    """(N, num_bits / 64) uint64 binary codes of vectors"""
+    bits = (np.asarray(vectors, dtype=np.float32) - mean) @ projection > 0
+    return np.packbits(bits, axis=1).view(np.uint64)
+
+
+def hamming_distances(codes1: np.ndarray, codes2: np.ndarray) -> np.ndarray:
+    """(N1, N2) uint16 Hamming distances between packed codes: XOR, then set bits counted 16 at a time from popcount_table"""
+    # one 16-bit column of both code sets at a time, which keeps every operation on large contiguous (N1, N2) arrays
+    columns1 = np.ascontiguousarray(codes1.view(np.uint16).T)
+    columns2 = np.ascontiguousarray(codes2.view(np.uint16).T)
+    distances = np.zeros((len(codes1), len(codes2)), dtype=np.uint16)
+    differences = np.empty_like(distances)
+    for column1, column2 in zip(columns1, columns2):
+        np.bitwise_xor(column1[:, np.newaxis], column2[np.newaxis, :], out=differences)
+        distances += popcount_table[differences]
+    return distances
+
+
+class SketchIndex(DescriptorIndex):
+    """Approximate search on binary sketches of the descriptors, re-ranked exactly.
+
+    Every descriptor is stored as num_bits (a multiple of 64) sign bits packed into uint64 words, 16 to 64 times less memory
+    than float32 descriptors for 256 to 64 bits. A query first finds its rerank_candidates nearest codes in Hamming distance,
+    scanning blocks of at most memory_budget bytes, then re-ranks them by exact distance on the stored descriptors.
+    Recall rises and speed falls with num_bits and rerank_candidates.
+    """
+
+    kind = "sketch"
+
+    def __init__(self, method: str = "SSD", num_bits: int = 128, projection: str = "itq", rerank_candidates: int = 32,
+                 max_training_samples: int = 50000, seed: int = 0) -> None:
+        super().__init__(method)
+        if num_bits % 64:
+            raise ValueError("num_bits must be a multiple of 64")
+        self.num_bits = num_bits
+        self.projection_kind = projection
+        self.rerank_candidates = rerank_candidates
+        self.max_training_samples = max_training_samples
+        self.seed = seed
+        self.mean = self.projection = self.codes = None
+
+    def build(self, descriptors: np.ndarray) -> "SketchIndex":
+        self.descriptors = np.asarray(descriptors)
+        vectors = self._vectors(self.descriptors)
+        random_state = np.random.default_rng(self.seed)
+        training_rows = np.sort(random_state.choice(len(vectors), min(len(vectors), self.max_training_samples), replace=False))
+        self.mean, self.projection = train_sketch_projection(vectors[training_rows], self.num_bits, self.projection_kind, seed=self.seed)
+        self.codes = sketch(vectors, self.mean, self.projection)
+        return self
+
+    def query(self, descriptors: np.ndarray, k: int = 1, rerank_candidates: int = None, memory_budget: int = 64 * 2 ** 20) -> tuple:
+        vectors = self._vectors(descriptors)
+        codes = sketch(vectors, self.mean, self.projection)
+        num_candidates = max(k, rerank_candidates or self.rerank_candidates)
+        candidate_ids = np.full((len(vectors), num_candidates), -1)
+        candidate_costs = np.full((len(vectors), num_candidates), np.inf, dtype=np.float32)
+        # a block pair holds uint16 XORs and distances, uint8 popcounts and float32 costs (11 bytes per pair, where
+        # match_block_shape assumes 8)
+        query_block_rows, train_block_rows = match_block_shape(len(vectors), len(self), memory_budget * 8 // 11)
+        for query_start in range(0, len(vectors), query_block_rows):
+            rows = slice(query_start, query_start + query_block_rows)
+            for train_start in range(0, len(self), train_block_rows):
+                costs = hamming_distances(codes[rows], self.codes[train_start:train_start + train_block_rows]).astype(np.float32)
+                columns, costs = smallest_costs(costs, num_candidates)
+                candidate_ids[rows], candidate_costs[rows] = merge_smallest_costs(
+                    candidate_ids[rows], candidate_costs[rows], np.where(columns >= 0, columns + train_start, -1), costs, num_candidates)
+        return self._rerank(descriptors, vectors, candidate_ids, k)
+
+    def _arrays(self) -> dict:
+        return {"descriptors": self.descriptors, "mean": self.mean, "projection": self.projection, "codes": self.codes,
+                "projection_kind": self.projection_kind, "rerank_candidates": self.rerank_candidates, "seed": self.seed}
+
+    @classmethod
+    def _from_arrays(cls, method: str, arrays) -> "SketchIndex":
+        index = cls(method, num_bits=arrays["projection"].shape[1], projection=str(arrays["projection_kind"]),
+                    rerank_candidates=int(arrays["rerank_candidates"]), seed=int(arrays["seed"]))
+        index.descriptors, index.mean, index.projection, index.codes = arrays["descriptors"], arrays["mean"], arrays["projection"], arrays["codes"]
+        return index
+
+
+index_kinds = {index_class.kind: index_class for index_class in (KDTreeIndex, IVFPQIndex, SketchIndex)}
+
+
+def build_index(descriptors: np.ndarray, kind: str = "kdtree", method: str = "SSD", **options) -> DescriptorIndex:
+    """Build a KDTreeIndex ("kdtree"), IVFPQIndex ("ivfpq") or SketchIndex ("sketch") over descriptors; options go to the index class"""
+    if kind not in index_kinds:
+        raise ValueError("kind must be one of {}".format(tuple(index_kinds)))
+    return index_kinds[kind](method, **options).build(descriptors)
+
+
+def load_index(path: str) -> DescriptorIndex:
+    """Read an index written by DescriptorIndex.save()"""
+    with np.load(path) as arrays:
+        arrays = dict(arrays)
+    return index_kinds[str(arrays["kind"])]._from_arrays(str(arrays["method"]), arrays)
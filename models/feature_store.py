@@ -0,0 +1,175 @@
+import json
+import os
+
+import numpy as np
+
+from models.sift import KeypointTable
+
+
+class FeatureStore:
+    """On-disk store of SIFT features for many images.
+
+    A store directory holds one raw file per keypoint column, one descriptor matrix file (float32, uint8 or float16)
+    and index.json, which maps each image id to its [start, stop) row range. Features are appended with add();
+    reads go through np.memmap, so only the rows that are touched are loaded into memory.
+    A uint8 store only takes descriptors with integer values in [0, 255], such as plain SIFT descriptors; RootSIFT
+    descriptors (floats in [0, 1]) need a float32 or float16 store.
+    """
+
+    index_file_name = "index.json"
+    descriptors_file_name = "descriptors.bin"
+    descriptor_dtypes = ("float32", "uint8", "float16")
+
+    def __init__(self, directory: str, descriptor_dtype: str = "float32", descriptor_size: int = 128) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        index_path = os.path.join(directory, self.index_file_name)
+        if os.path.exists(index_path):
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+            descriptor_dtype, descriptor_size = index["descriptor_dtype"], index["descriptor_size"]
+            self.num_rows = index["num_rows"]
+            self.row_ranges = {image_id: tuple(row_range) for image_id, row_range in index["images"].items()}
+        else:
+            self.num_rows = 0
+            self.row_ranges = {}
+        if descriptor_dtype not in self.descriptor_dtypes:
+            raise ValueError("descriptor_dtype must be one of {}".format(self.descriptor_dtypes))
+        self.descriptor_dtype = np.dtype(descriptor_dtype)
+        self.descriptor_size = descriptor_size
+        self._memmaps = {}
+        self._files_checked = False
+
+    def __len__(self) -> int:
+        return len(self.row_ranges)
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self.row_ranges
+
+    def __enter__(self) -> "FeatureStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+    def image_ids(self) -> list:
+        return list(self.row_ranges)
+
+    def row_range(self, image_id: str) -> tuple:
+        return self.row_ranges[image_id]
+
+    def add(self, image_id: str, keypoints: KeypointTable, descriptors: np.ndarray) -> tuple:
+        """Append the features of one image and return its row range. The index is written by flush()"""
+        image_id = str(image_id)
+        if image_id in self.row_ranges:
+            raise ValueError("Image id '{}' is already in the feature store".format(image_id))
+        descriptors = np.asarray(descriptors).reshape(-1, self.descriptor_size)
+        if len(descriptors) != len(keypoints):
+            raise ValueError("Got {} keypoints but {} descriptors".format(len(keypoints), len(descriptors)))
+        self.check_descriptors(image_id, descriptors)
+        if not self._files_checked:
+            # files may hold rows of an add() that was never flushed; they are cut back to the indexed rows before appending
+            self._truncate_files()
+            self._files_checked = True
+
+        for column in KeypointTable.columns:
+            self._append(self._column_path(column), getattr(keypoints, column))
+        self._append(self._descriptors_path(), descriptors.astype(self.descriptor_dtype))
+        row_range = (self.num_rows, self.num_rows + len(keypoints))
+        self.row_ranges[image_id] = row_range
+        self.num_rows = row_range[1]
+        # memory maps only cover the rows that existed when they were opened
+        self._memmaps.clear()
+        return row_range
+
+    def check_descriptors(self, image_id: str, descriptors: np.ndarray) -> None:
+        """Raise ValueError if the descriptors of an image would change when cast to the store's dtype: an integer store
+        takes only integer values within its range (RootSIFT into uint8 would silently become all zeros)"""
+        descriptors = np.asarray(descriptors)
+        if not np.issubdtype(self.descriptor_dtype, np.integer) or np.can_cast(descriptors.dtype, self.descriptor_dtype) or not descriptors.size:
+            return
+        dtype_info = np.iinfo(self.descriptor_dtype)
+        if not np.array_equal(descriptors, np.round(descriptors)) or descriptors.min() < dtype_info.min or descriptors.max() > dtype_info.max:
+            raise ValueError("Descriptors of image '{}' are not integers in [{}, {}] and cannot be stored as {}".format(
+                image_id, dtype_info.min, dtype_info.max, self.descriptor_dtype.name))
+
+    def flush(self) -> None:
+        """Write the index file; rows added since the last flush are only visible to other readers after it"""
+        index = {
+            "descriptor_dtype": self.descriptor_dtype.name,
+            "descriptor_size": self.descriptor_size,
+            "num_rows": self.num_rows,
+            "images": {image_id: list(row_range) for image_id, row_range in self.row_ranges.items()},
+        }
+        index_path = os.path.join(self.directory, self.index_file_name)
+        with open(index_path + ".tmp", "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(index_path + ".tmp", index_path)
+
+    def keypoints(self, image_id: str = None) -> KeypointTable:
+        """Keypoints of one image, or of all images when image_id is None, as memory-mapped columns"""
+        rows = self._rows(image_id)
+        return KeypointTable(**{column: self._memmap(column)[rows] for column in KeypointTable.columns})
+
+    def descriptors(self, image_id: str = None) -> np.ndarray:
+        """Memory-mapped descriptors of one image, or of all images when image_id is None"""
+        return self._memmap("descriptors")[self._rows(image_id)]
+
+    def descriptor_blocks(self, rows_per_block: int = 2 ** 16):
+        """Yield (start_row, descriptors) blocks of the whole descriptor matrix, for scans that must stay memory-bounded"""
+        descriptors = self._memmap("descriptors")
+        for start in range(0, self.num_rows, rows_per_block):
+            yield start, descriptors[start:start + rows_per_block]
+
+    def image_ids_of_rows(self, rows: np.ndarray) -> list:
+        """Map global descriptor rows (e.g. match indices into descriptors()) back to image ids"""
+        image_ids = list(self.row_ranges)
+        starts = np.array([self.row_ranges[image_id][0] for image_id in image_ids])
+        stops = np.array([self.row_ranges[image_id][1] for image_id in image_ids])
+        order = np.argsort(starts, kind="stable")
+        # empty images share their start row with the next image, so the last range starting at or before the row is the one holding it
+        positions = order[np.searchsorted(starts[order], rows, side="right") - 1]
+        if np.any((np.asarray(rows) < 0) | (np.asarray(rows) >= stops[positions])):
+            raise IndexError("Row out of range of the feature store")
+        return [image_ids[position] for position in np.atleast_1d(positions).tolist()]
+
+    def _rows(self, image_id: str) -> slice:
+        if image_id is None:
+            return slice(0, self.num_rows)
+        return slice(*self.row_ranges[str(image_id)])
+
+    def _column_path(self, column: str) -> str:
+        return os.path.join(self.directory, column + ".bin")
+
+    def _descriptors_path(self) -> str:
+        return os.path.join(self.directory, self.descriptors_file_name)
+
+    def _column_layout(self, name: str) -> tuple:
+        if name == "descriptors":
+            return self._descriptors_path(), self.descriptor_dtype, (self.num_rows, self.descriptor_size)
+        return self._column_path(name), getattr(KeypointTable(), name).dtype, (self.num_rows,)
+
+    def _memmap(self, name: str) -> np.ndarray:
+        if name not in self._memmaps:
+            path, dtype, shape = self._column_layout(name)
+            # np.memmap cannot map empty files
+            if self.num_rows == 0:
+                self._memmaps[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self._memmaps[name] = np.memmap(path, dtype=dtype, mode="r", shape=shape)
+        return self._memmaps[name]
+
+    def _append(self, path: str, array: np.ndarray) -> None:
+        with open(path, "ab") as data_file:
+            data_file.write(np.ascontiguousarray(array).tobytes())
+
+    def _truncate_files(self) -> None:
+        for name in KeypointTable.columns + ("descriptors",):
+            path, dtype, shape = self._column_layout(name)
+            expected_size = int(np.prod(shape)) * dtype.itemsize
+            if not os.path.exists(path):
+                open(path, "wb").close()
+            if os.path.getsize(path) != expected_size:
+                if os.path.getsize(path) < expected_size:
+                    raise ValueError("Feature store file '{}' is shorter than its index".format(path))
+                os.truncate(path, expected_size)
@@ -1,7 +1,30 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import cv2
 from models.sift import computeKeypointsAndDescriptors
-from models.image import rgb2gray
+from models.image import Image, rgb2gray
+from utils.cache import LRUCache, array_fingerprint
+
+# Nearest-neighbour results of recently matched descriptor pairs (see match_neighbours)
+match_cache = LRUCache(max_bytes=64 * 2 ** 20)
+
+# Matching methods offered in the match tab: (score, Lowe ratio or None for fixed thresholds, mutual nearest-neighbour check)
+lowe_ratio = 0.8
+match_methods = {
+    "SSD": ("SSD", None, False),
+    "NCC": ("NCC", None, False),
+    "SSD Ratio Test": ("SSD", lowe_ratio, False),
+    "NCC Ratio Test": ("NCC", lowe_ratio, False),
+    "SSD Ratio + Cross Check": ("SSD", lowe_ratio, True),
+    "NCC Ratio + Cross Check": ("NCC", lowe_ratio, True),
+}
+
+def as_float_descriptors(descriptors):
+    # uint8 / float16 descriptors (see output_format of computeKeypointsAndDescriptors) are matched in float32,
+    # uint8 differences would wrap around otherwise
+    return np.asarray(descriptors, dtype=np.float32)
 
 def calculate_SSD(des1,des2):
     ssd = 0
@@ -10,6 +33,22 @@ def calculate_SSD(des1,des2):
     ssd = np.sqrt(ssd)
     return ssd
 
+def ssd_distance_matrix(descriptor1, descriptor2):
+    # Euclidean distances between all rows of descriptor1 and descriptor2 (calculate_SSD of every pair), from
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b so that almost all of the work is one BLAS matrix product
+    distances = descriptor1 @ descriptor2.T
+    distances *= -2
+    distances += np.einsum("ij,ij->i", descriptor1, descriptor1)[:, np.newaxis]
+    distances += np.einsum("ij,ij->i", descriptor2, descriptor2)[np.newaxis, :]
+    # Rounding can push the squared distance of (nearly) identical descriptors slightly below zero
+    np.maximum(distances, 0, out=distances)
+    return np.sqrt(distances, out=distances)
+
+def create_matches(query_indices, train_indices, distances):
+    # queryIdx: index of the feature in the first image, trainIdx: in the second image, distance: SSD distance or NCC score
+    return [cv2.DMatch(query_index, train_index, distance)
+            for query_index, train_index, distance in zip(query_indices.tolist(), train_indices.tolist(), distances.tolist())]
+
 def calculate_NCC(image_1_descriptors, image_2_descriptors):
     image_1_descriptors_norm = (image_1_descriptors - np.mean(image_1_descriptors)) / np.std(image_1_descriptors)
     image_2_descriptors_norm = (image_2_descriptors - np.mean(image_2_descriptors)) / np.std(image_2_descriptors)
@@ -18,59 +57,408 @@ def calculate_NCC(image_1_descriptors, image_2_descriptors):
     ncc = np.dot(image_1_descriptors_norm, image_2_descriptors_norm) / len(image_1_descriptors)
     return ncc
 
-def feature_matching(descriptor1, descriptor2, method, threshold1, threshold2):
-    keyPoints1 = descriptor1.shape[0]
-    keyPoints2 = descriptor2.shape[0]
-
-    matched_features = []
-    for kp1 in range(keyPoints1):
-        # Initial variables (will be updated) where distance for SSD is a distance and for
-        # NCC it is the correlation score
-        score = np.inf if(method == "SSD") else -np.inf
-        y_index = -1
-        
-        for kp2 in range(keyPoints2):
-            if method == "SSD":
-                distance = calculate_SSD(descriptor1[kp1], descriptor2[kp2])
-                # print(score)
-                if distance < score:
-                    score = distance
-                    y_index = kp2
-
-            elif method == "NCC":
-                corr_score = calculate_NCC(descriptor1[kp1], descriptor2[kp2])
-                if corr_score > score:
-                    score = corr_score
-                    y_index = kp2
-
-        if method == "SSD":
-            # Score here indicates distance for SSD
-            if score >= threshold1 and score <= threshold2:
-                feature = cv2.DMatch()
-                # The index of the feature in the first image
-                feature.queryIdx = kp1
-                #  The index of the feature in the second image
-                feature.trainIdx = y_index
-                # The distance between the two features
-                feature.distance = score
-                matched_features.append(feature)
-        else:
-            # Score here indicates correlation score for SSD
-            # NCC takes all keypoints having a correlation score higher than 0.75
-            if(score >= 0.75):
-                feature = cv2.DMatch()
-                feature.queryIdx = kp1
-                feature.trainIdx = y_index
-                feature.distance = score
-                matched_features.append(feature)
-
-    return matched_features
-
-def draw_matching(image_1, image_2, method, threshold1, threshold2):
+def z_normalize(descriptors):
+    # Each descriptor minus its mean, over its standard deviation (what calculate_NCC does per pair), for all rows at once
+    return (descriptors - np.mean(descriptors, axis=1, keepdims=True)) / np.std(descriptors, axis=1, keepdims=True)
+
+def ncc_score_matrix(normalized_descriptor1, normalized_descriptor2):
+    # calculate_NCC of every pair of z-normalized descriptors, all from one matrix product
+    return (normalized_descriptor1 @ normalized_descriptor2.T) / normalized_descriptor1.shape[1]
+
+def match_block_shape(num_queries, num_trains, memory_budget):
+    # Rows of the query and train blocks whose float32 score matrix (and one temporary of the same size) fits in memory_budget bytes
+    if memory_budget is None:
+        return max(num_queries, 1), max(num_trains, 1)
+    block_size = max(int(memory_budget) // 8, 1)
+    query_block_rows = min(max(num_queries, 1), max(int(np.sqrt(block_size)), 1))
+    train_block_rows = min(max(num_trains, 1), max(block_size // query_block_rows, 1))
+    return query_block_rows, train_block_rows
+
+def prepare_descriptors(descriptors, method):
+    descriptors = as_float_descriptors(descriptors)
+    return z_normalize(descriptors) if method == "NCC" else descriptors
+
+def match_costs(query_block, train_block, method):
+    # Score matrix of a query / train block pair as costs, lower is better: SSD distances or negated NCC scores
+    if method == "SSD":
+        return ssd_distance_matrix(query_block, train_block)
+    costs = ncc_score_matrix(query_block, train_block)
+    np.negative(costs, out=costs)
+    # Descriptors with zero variance have no correlation; calculate_NCC gives them NaN, which never wins
+    costs[np.isnan(costs)] = np.inf
+    return costs
+
+def smallest_costs(costs, k):
+    # The k smallest costs of every row and their columns, smallest first; argmin keeps the first of equal costs,
+    # like the strict comparison of a scan over the second image. Overwrites costs
+    rows = np.arange(len(costs))
+    columns = np.full((len(costs), k), -1)
+    values = np.full((len(costs), k), np.inf, dtype=costs.dtype)
+    for j in range(min(k, costs.shape[1])):
+        columns[:, j] = np.argmin(costs, axis=1)
+        values[:, j] = costs[rows, columns[:, j]]
+        costs[rows, columns[:, j]] = np.inf
+    return columns, values
+
+def merge_smallest_costs(indices, costs, new_indices, new_costs, k):
+    # The k smallest of two (rows, *) candidate sets per row, smallest first; equal costs go to the smaller index, -1 (no candidate) last
+    candidate_indices = np.hstack([indices, new_indices])
+    candidate_costs = np.hstack([costs, new_costs])
+    order = np.lexsort((np.where(candidate_indices >= 0, candidate_indices, np.iinfo(candidate_indices.dtype).max), candidate_costs))[:, :k]
+    return np.take_along_axis(candidate_indices, order, axis=1), np.take_along_axis(candidate_costs, order, axis=1)
+
+def exact_scores(descriptor1, descriptor2, train_indices, method):
+    # SSD distances or NCC scores of (query row, train_indices[row]) pairs computed as calculate_SSD / calculate_NCC do,
+    # since the matrix expansion sums in another order (and loses precision to cancellation for close SSD descriptors)
+    valid = train_indices >= 0
+    scores = np.full(len(train_indices), np.inf if method == "SSD" else -np.inf)
+    query_descriptors = as_float_descriptors(descriptor1[np.flatnonzero(valid)])
+    train_descriptors = as_float_descriptors(descriptor2[train_indices[valid]])
+    if method == "SSD":
+        # Squared and summed in float64 over dimensions in the same order as calculate_SSD
+        squared_distances = np.zeros(len(query_descriptors))
+        for differences in (query_descriptors - train_descriptors).T:
+            squared_distances += differences.astype(np.float64) ** 2
+        scores[valid] = np.sqrt(squared_distances)
+    else:
+        correlations = [np.dot(query_row, train_row) for query_row, train_row in zip(z_normalize(query_descriptors), z_normalize(train_descriptors))]
+        scores[valid] = np.array(correlations, dtype=np.float64).reshape(-1) / descriptor1.shape[1]
+    return scores
+
+def nearest_neighbors(descriptor1, descriptor2, method, k=1, memory_budget=None, progress_callback=None, return_reverse=False, num_workers=1):
+    # The k best train descriptors (rows of descriptor2) of every query descriptor (rows of descriptor1), best first, as
+    # (N, k) train indices and scores (SSD distances or NCC correlations, -1 / inf / -inf where there are fewer than k).
+    # Without memory_budget all scores are one matrix. With memory_budget (bytes) the query and train sets are matched in
+    # blocks whose score matrices fit in it while a running top-k is kept per query row, so peak memory does not grow with
+    # the train set, which can be a memory map (e.g. FeatureStore.descriptors()) read one block at a time.
+    # progress_callback(matched_pairs, total_pairs) is called after every block.
+    # With return_reverse, the best query index of every train descriptor (-1 if none) is found from the same score
+    # blocks and returned third, for mutual nearest-neighbour checks.
+    # With num_workers > 1 the query rows are split into at least num_workers blocks matched on a thread pool (NumPy
+    # releases the GIL in the matrix products); memory_budget is then shared between the workers. Results do not change.
+    # descriptor2 can also be a prebuilt index (see models.descriptor_index), which then searches its own train set
+    if hasattr(descriptor2, "query"):
+        if descriptor2.method != method:
+            raise ValueError("The index was built for {} matching, not {}".format(descriptor2.method, method))
+        if return_reverse:
+            raise ValueError("Reverse matches need the train descriptors, not an index")
+        return descriptor2.query(descriptor1, k)
+    num_queries, num_trains = len(descriptor1), len(descriptor2)
+    num_workers = max(num_workers, 1)
+    query_block_rows, train_block_rows = match_block_shape(num_queries, num_trains, None if memory_budget is None else memory_budget // num_workers)
+    query_block_rows = min(query_block_rows, max(-(-num_queries // num_workers), 1))
+    train_indices = np.full((num_queries, k), -1)
+    costs = np.full((num_queries, k), np.inf, dtype=np.float32)
+    reverse_indices = np.full(num_trains, -1)
+    reverse_costs = np.full(num_trains, np.inf, dtype=np.float32)
+    lock = threading.Lock()
+    matched_pairs = [0]
+
+    def match_query_block(query_start):
+        # Each query block owns its rows of train_indices / costs; reverse matches and progress are shared under the lock
+        query_block = prepare_descriptors(descriptor1[query_start:query_start + query_block_rows], method)
+        rows = slice(query_start, query_start + len(query_block))
+        for train_start in range(0, num_trains, train_block_rows):
+            train_block = prepare_descriptors(descriptor2[train_start:train_start + train_block_rows], method)
+            block_costs = match_costs(query_block, train_block, method)
+            if return_reverse:
+                # Best query of every train column; equal costs go to the smaller query index, whatever order blocks finish in
+                columns = slice(train_start, train_start + len(train_block))
+                block_rows = np.argmin(block_costs, axis=0)
+                block_reverse_costs = block_costs[block_rows, np.arange(len(train_block))]
+                with lock:
+                    is_better = (block_reverse_costs < reverse_costs[columns]) | \
+                                ((block_reverse_costs == reverse_costs[columns]) & (block_rows + query_start < reverse_indices[columns]))
+                    reverse_indices[columns] = np.where(is_better, block_rows + query_start, reverse_indices[columns])
+                    reverse_costs[columns] = np.where(is_better, block_reverse_costs, reverse_costs[columns])
+            block_columns, block_costs = smallest_costs(block_costs, k)
+            train_indices[rows], costs[rows] = merge_smallest_costs(
+                train_indices[rows], costs[rows], np.where(block_columns >= 0, block_columns + train_start, -1), block_costs, k)
+            if progress_callback is not None:
+                with lock:
+                    matched_pairs[0] += len(query_block) * len(train_block)
+                    progress_callback(matched_pairs[0], num_queries * num_trains)
+
+    query_starts = range(0, num_queries, query_block_rows)
+    if num_workers > 1 and len(query_starts) > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            # list() re-raises the first exception of a block
+            list(executor.map(match_query_block, query_starts))
+    else:
+        for query_start in query_starts:
+            match_query_block(query_start)
+    scores = np.stack([exact_scores(descriptor1, descriptor2, train_indices[:, j], method) for j in range(k)], axis=1)
+    if return_reverse:
+        return train_indices, scores.reshape(num_queries, k), reverse_indices
+    return train_indices, scores.reshape(num_queries, k)
+
+def select_SSD(train_indices, scores, threshold1, threshold2):
+    # Matches whose best SSD distance (first column of nearest_neighbors output) lies in [threshold1, threshold2]
+    train_indices, scores = train_indices[:, 0], scores[:, 0]
+    is_matched = (train_indices >= 0) & (scores >= threshold1) & (scores <= threshold2)
+    return create_matches(np.flatnonzero(is_matched), train_indices[is_matched], scores[is_matched])
+
+def select_NCC(train_indices, scores, threshold=0.75):
+    # NCC takes all keypoints having a correlation score higher than the threshold
+    train_indices, scores = train_indices[:, 0], scores[:, 0]
+    is_matched = (train_indices >= 0) & (scores >= threshold)
+    return create_matches(np.flatnonzero(is_matched), train_indices[is_matched], scores[is_matched])
+
+def select_ratio_test(train_indices, scores, method, ratio=0.8, reverse_indices=None):
+    # Lowe's ratio test on two neighbours per query: keep a match only when its best neighbour is clearly closer than
+    # the second best (distance below ratio times the second distance). With reverse_indices (cross check), the query
+    # must also be the best match of its train descriptor (mutual nearest neighbours)
+    if method == "SSD":
+        distances = scores
+    else:
+        # Euclidean distance between z-normalized descriptors, up to a constant factor: |a - b|^2 = 2 d (1 - ncc)
+        distances = np.sqrt(np.maximum(2 * (1 - scores), 0))
+    # A single train descriptor has no second neighbour (infinite distance), so its match always passes
+    is_matched = (train_indices[:, 0] >= 0) & (distances[:, 0] < ratio * distances[:, 1])
+    if reverse_indices is not None:
+        # Queries without a neighbour (-1, e.g. an empty train set) have no reverse match to check
+        is_mutual = np.zeros(len(train_indices), dtype=bool)
+        has_neighbour = np.flatnonzero(train_indices[:, 0] >= 0)
+        is_mutual[has_neighbour] = reverse_indices[train_indices[has_neighbour, 0]] == has_neighbour
+        is_matched &= is_mutual
+    return create_matches(np.flatnonzero(is_matched), train_indices[is_matched, 0], scores[is_matched, 0])
+
+def match_SSD(descriptor1, descriptor2, threshold1, threshold2, memory_budget=None, progress_callback=None, num_workers=1):
+    train_indices, scores = nearest_neighbors(descriptor1, descriptor2, "SSD", 1, memory_budget, progress_callback, num_workers=num_workers)
+    return select_SSD(train_indices, scores, threshold1, threshold2)
+
+def match_NCC(descriptor1, descriptor2, threshold=0.75, memory_budget=None, progress_callback=None, num_workers=1):
+    train_indices, scores = nearest_neighbors(descriptor1, descriptor2, "NCC", 1, memory_budget, progress_callback, num_workers=num_workers)
+    return select_NCC(train_indices, scores, threshold)
+
+def match_ratio_test(descriptor1, descriptor2, method, ratio=0.8, cross_check=False, memory_budget=None, progress_callback=None, num_workers=1):
+    # Ratio test and cross check (see select_ratio_test) both come from the same pass over the score blocks
+    neighbours = nearest_neighbors(descriptor1, descriptor2, method, 2, memory_budget, progress_callback, cross_check, num_workers)
+    return select_ratio_test(neighbours[0], neighbours[1], method, ratio, neighbours[2] if cross_check else None)
+
+def match_neighbours(descriptor1, descriptor2, score, memory_budget=None, progress_callback=None, num_workers=1, cache=match_cache):
+    # Threshold-independent stage of feature_matching: the two best train descriptors of every query with their scores,
+    # and the best query of every train descriptor, which serve every method of one score (see match_methods).
+    # Results are cached by descriptor content, so changing thresholds, ratio or cross check only re-runs the cheap filtering;
+    # callers get copies, so the cached arrays cannot be changed through them.
+    # A prebuilt index (see models.descriptor_index) gives no reverse matches (None) and is not cached
+    if hasattr(descriptor2, "query"):
+        return nearest_neighbors(descriptor1, descriptor2, score, 2) + (None,)
+    if cache is None:
+        return nearest_neighbors(descriptor1, descriptor2, score, 2, memory_budget, progress_callback, True, num_workers)
+    key = (array_fingerprint(descriptor1), array_fingerprint(descriptor2), score)
+    neighbours = cache.get(key)
+    if neighbours is None:
+        neighbours = nearest_neighbors(descriptor1, descriptor2, score, 2, memory_budget, progress_callback, True, num_workers)
+        cache.put(key, neighbours, sum(array.nbytes for array in neighbours))
+    return tuple(array.copy() for array in neighbours)
+
+def feature_matching(descriptor1, descriptor2, method, threshold1, threshold2, memory_budget=None, progress_callback=None, num_workers=1,
+                     cache=match_cache):
+    # Descriptors are converted to float32 block by block (see nearest_neighbors), so large memory-mapped sets are never loaded whole.
+    # Pass cache=None to skip hashing very large descriptor sets
+    if method not in match_methods:
+        return []
+    score, ratio, cross_check = match_methods[method]
+    train_indices, scores, reverse_indices = match_neighbours(descriptor1, descriptor2, score, memory_budget, progress_callback, num_workers, cache)
+    if ratio is not None:
+        if cross_check and reverse_indices is None:
+            raise ValueError("Reverse matches need the train descriptors, not an index")
+        # The ratio test replaces the fixed SSD band / NCC cutoff
+        return select_ratio_test(train_indices, scores, score, ratio, reverse_indices if cross_check else None)
+    elif score == "SSD":
+        return select_SSD(train_indices, scores, threshold1, threshold2)
+    # NCC takes all keypoints having a correlation score higher than 0.75
+    return select_NCC(train_indices, scores)
+
+def match_one_to_many(descriptor1, descriptor_sets, method, threshold1, threshold2, memory_budget=None, num_workers=1):
+    # Match one query descriptor set against many train sets (e.g. every image of a gallery), one DMatch list per train set.
+    # Train sets are matched concurrently on a thread pool, each within memory_budget / num_workers bytes
+    block_budget = None if memory_budget is None else memory_budget // max(num_workers, 1)
+    def match_train_set(descriptor2):
+        return feature_matching(descriptor1, descriptor2, method, threshold1, threshold2, block_budget)
+    if num_workers <= 1:
+        return [match_train_set(descriptor2) for descriptor2 in descriptor_sets]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(match_train_set, descriptor_sets))
+
+# Correspondences in a minimal RANSAC sample of each geometric model
+ransac_sample_sizes = {"homography": 4, "fundamental": 8}
+
+def keypoint_points(keypoints):
+    # (N, 2) float64 coordinates of a KeypointTable or a list of cv2.KeyPoint
+    if hasattr(keypoints, "points"):
+        return keypoints.points.astype(np.float64)
+    return np.array([keypoint.pt for keypoint in keypoints], dtype=np.float64).reshape(-1, 2)
+
+def normalize_points(points):
+    # Hartley normalization of a (B, n, 2) batch of point sets: centroid moved to the origin, mean distance scaled to sqrt(2).
+    # Returns the (B, n, 2) normalized points and the (B, 3, 3) transforms that produce them
+    centroids = np.mean(points, axis=1, keepdims=True)
+    scales = np.sqrt(2) / np.maximum(np.mean(np.linalg.norm(points - centroids, axis=2), axis=1), 1e-12)
+    transforms = np.zeros((len(points), 3, 3))
+    transforms[:, 0, 0] = transforms[:, 1, 1] = scales
+    transforms[:, :2, 2] = -scales[:, np.newaxis] * centroids[:, 0]
+    transforms[:, 2, 2] = 1
+    return (points - centroids) * scales[:, np.newaxis, np.newaxis], transforms
+
+def fit_homographies(points1, points2):
+    # Normalized DLT for a batch of (B, n, 2) correspondences (n >= 4): (B, 3, 3) homographies H with points2 ~ H points1
+    normalized1, transforms1 = normalize_points(points1)
+    normalized2, transforms2 = normalize_points(points2)
+    x, y = normalized1[..., 0], normalized1[..., 1]
+    u, v = normalized2[..., 0], normalized2[..., 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+    equations = np.concatenate([np.stack([-x, -y, -ones, zeros, zeros, zeros, u * x, u * y, u], axis=2),
+                                np.stack([zeros, zeros, zeros, -x, -y, -ones, v * x, v * y, v], axis=2)], axis=1)
+    # The solution is the right singular vector of the smallest singular value
+    homographies = np.linalg.svd(equations)[2][:, -1].reshape(-1, 3, 3)
+    homographies = np.linalg.inv(transforms2) @ homographies @ transforms1
+    return homographies / np.linalg.norm(homographies, axis=(1, 2), keepdims=True)
+
+def fit_fundamental_matrices(points1, points2):
+    # Normalized 8-point algorithm for a batch of (B, n, 2) correspondences (n >= 8):
+    # (B, 3, 3) rank-2 fundamental matrices F with [points2, 1] F [points1, 1]^T = 0
+    normalized1, transforms1 = normalize_points(points1)
+    normalized2, transforms2 = normalize_points(points2)
+    x, y = normalized1[..., 0], normalized1[..., 1]
+    u, v = normalized2[..., 0], normalized2[..., 1]
+    equations = np.stack([u * x, u * y, u, v * x, v * y, v, x, y, np.ones_like(x)], axis=2)
+    fundamentals = np.linalg.svd(equations)[2][:, -1].reshape(-1, 3, 3)
+    # Rank 2: the smallest singular value is set to zero
+    left, singular_values, right = np.linalg.svd(fundamentals)
+    singular_values[:, 2] = 0
+    fundamentals = (left * singular_values[:, np.newaxis, :]) @ right
+    fundamentals = transforms2.transpose(0, 2, 1) @ fundamentals @ transforms1
+    return fundamentals / np.linalg.norm(fundamentals, axis=(1, 2), keepdims=True)
+
+def homography_errors(homographies, points1, points2):
+    # (B, N) squared distances between points2 and points1 mapped by each of (B, 3, 3) homographies
+    projected = homographies @ np.vstack([points1.T, np.ones(len(points1))])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        errors = np.sum((projected[:, :2] / projected[:, 2:] - points2.T) ** 2, axis=1)
+    # Points mapped to infinity never fit
+    return np.where(np.isnan(errors), np.inf, errors)
+
+def sampson_errors(fundamentals, points1, points2):
+    # (B, N) Sampson distances (first-order squared geometric errors) of the correspondences under each of (B, 3, 3) fundamental matrices
+    homogeneous1 = np.vstack([points1.T, np.ones(len(points1))])
+    homogeneous2 = np.vstack([points2.T, np.ones(len(points2))])
+    lines2 = fundamentals @ homogeneous1
+    lines1 = fundamentals.transpose(0, 2, 1) @ homogeneous2
+    algebraic_errors = np.sum(homogeneous2 * lines2, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        errors = algebraic_errors ** 2 / (lines2[:, 0] ** 2 + lines2[:, 1] ** 2 + lines1[:, 0] ** 2 + lines1[:, 1] ** 2)
+    return np.where(np.isnan(errors), np.inf, errors)
+
+def has_repeated_points(points):
+    # For a (B, n, 2) batch of samples, whether each has two (nearly) coinciding points, e.g. several matches to one keypoint,
+    # which constrain nothing and let degenerate models collapse the other image onto that point
+    squared_distances = np.sum((points[:, :, np.newaxis] - points[:, np.newaxis]) ** 2, axis=3)
+    squared_distances[:, np.arange(points.shape[1]), np.arange(points.shape[1])] = np.inf
+    return np.min(squared_distances, axis=(1, 2)) < 1e-6
+
+def degenerate_fundamental_samples(points1, points2):
+    # For a (B, 8, 2) batch of samples in both images, whether each is degenerate (has repeated points)
+    return has_repeated_points(points1) | has_repeated_points(points2)
+
+def degenerate_homography_samples(points1, points2):
+    # For a (B, 4, 2) batch of samples in both images, whether each is degenerate. Besides repeated points: a homography keeps
+    # the orientation of every triangle of the sample or flips all of them (cv2.findHomography checks the same). Samples whose
+    # triangles disagree, or with three collinear points, fit (near) rank-deficient matrices that collapse the image onto a
+    # line or point and then "explain" every match to a keypoint there
+    triangles = np.array([[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]])
+    def orientations(points):
+        corners = points[:, triangles]
+        edges1, edges2 = corners[:, :, 1] - corners[:, :, 0], corners[:, :, 2] - corners[:, :, 0]
+        return np.sign(edges1[..., 0] * edges2[..., 1] - edges1[..., 1] * edges2[..., 0])
+    products = orientations(points1) * orientations(points2)
+    is_consistent = np.all(products > 0, axis=1) | np.all(products < 0, axis=1)
+    return ~is_consistent | has_repeated_points(points1) | has_repeated_points(points2)
+
+# Per model: fit a (B, n, 2) batch of samples, errors of all correspondences, and which samples are degenerate
+geometric_models = {"homography": (fit_homographies, homography_errors, degenerate_homography_samples),
+                    "fundamental": (fit_fundamental_matrices, sampson_errors, degenerate_fundamental_samples)}
+
+def ransac_iterations(inlier_ratio, sample_size, confidence):
+    # Number of samples needed to draw at least one all-inlier sample with the given confidence
+    all_inlier_probability = inlier_ratio ** sample_size
+    if all_inlier_probability >= 1:
+        return 1
+    if all_inlier_probability <= 0:
+        return np.inf
+    return int(np.ceil(np.log(1 - confidence) / np.log1p(-all_inlier_probability)))
+
+def verify_matches(keypoints1, keypoints2, matches, model="homography", threshold=3.0, confidence=0.99,
+                   max_iterations=2000, batch_size=64, min_inliers=None, min_inlier_ratio=0.25, seed=0):
+    # RANSAC geometric verification of matches (cv2.DMatch list) between two keypoint sets.
+    # Hypotheses are fitted and scored batch_size at a time against all correspondences as arrays; a correspondence is an
+    # inlier when its transfer (homography) or Sampson (fundamental) error is below threshold pixels. Degenerate samples
+    # (repeated points, and for homographies collinear or inconsistently oriented ones) are skipped, and inliers are counted
+    # one-to-one: the matches sharing a keypoint count as one together, since a model through that keypoint "explains" all of them.
+    # A model is accepted with at least min_inliers inliers (default twice the sample size) that are also at least
+    # min_inlier_ratio of the matches, since with enough random matches some model always fits a fixed number of them.
+    # The number of batches adapts to the best inlier ratio found so far, starting from min_inlier_ratio: pairs are rejected
+    # early, without a model, once enough samples have been scored to find an acceptable model at the given confidence and
+    # none was found.
+    # Returns the boolean inlier mask over matches and the 3x3 model refitted to all inliers, or None for rejected pairs
+    if model not in geometric_models:
+        raise ValueError("model must be one of {}".format(tuple(geometric_models)))
+    fit_models, model_errors, degenerate_samples = geometric_models[model]
+    sample_size = ransac_sample_sizes[model]
+    num_matches = len(matches)
+    inlier_mask = np.zeros(num_matches, dtype=bool)
+    if num_matches < sample_size:
+        return inlier_mask, None
+
+    query_indices = np.array([match.queryIdx for match in matches])
+    train_indices = np.array([match.trainIdx for match in matches])
+    points1 = keypoint_points(keypoints1)[query_indices]
+    points2 = keypoint_points(keypoints2)[train_indices]
+    # Weight of each match in the inlier counts: one over the number of matches sharing its query or train keypoint
+    weights = 1 / np.maximum(np.bincount(query_indices)[query_indices], np.bincount(train_indices)[train_indices])
+    num_distinct = np.sum(weights)
+    min_inliers = 2 * sample_size if min_inliers is None else max(min_inliers, sample_size)
+    min_inliers = max(min_inliers, min_inlier_ratio * num_distinct)
+    if num_distinct < min_inliers:
+        return inlier_mask, None
+
+    squared_threshold = threshold ** 2
+    random_state = np.random.default_rng(seed)
+    best_count, best_model = 0, None
+    num_iterations = 0
+    while num_iterations < min(ransac_iterations(max(best_count, min_inliers) / num_distinct, sample_size, confidence), max_iterations):
+        num_samples = min(batch_size, max_iterations - num_iterations)
+        # Distinct correspondences for each sample: the sample_size smallest of random keys per row
+        samples = np.argpartition(random_state.random((num_samples, num_matches)), sample_size - 1, axis=1)[:, :sample_size]
+        models = fit_models(points1[samples], points2[samples])
+        inlier_counts = (model_errors(models, points1, points2) < squared_threshold) @ weights
+        inlier_counts[degenerate_samples(points1[samples], points2[samples])] = 0
+        best_sample = np.argmax(inlier_counts)
+        if inlier_counts[best_sample] > best_count:
+            best_count, best_model = inlier_counts[best_sample], models[best_sample]
+        num_iterations += num_samples
+
+    if best_count < min_inliers:
+        return inlier_mask, None
+    inlier_mask = model_errors(best_model[np.newaxis], points1, points2)[0] < squared_threshold
+    # Least-squares refit on all inliers, kept when it does not lose inliers
+    refitted_model = fit_models(points1[inlier_mask][np.newaxis], points2[inlier_mask][np.newaxis])[0]
+    refitted_mask = model_errors(refitted_model[np.newaxis], points1, points2)[0] < squared_threshold
+    if refitted_mask @ weights >= best_count:
+        inlier_mask, best_model = refitted_mask, refitted_model
+    return inlier_mask, best_model / best_model[2, 2] if model == "homography" and best_model[2, 2] != 0 else best_model
+
+def draw_matching(image_1, image_2, method, threshold1, threshold2, descriptor_format="float32", verification=None, num_workers=1):
     # Compute keypoints and descriptors on "gray" images only
-    kps1, descriptors1 = computeKeypointsAndDescriptors(rgb2gray(image_1))
-    kps2, descriptors2 = computeKeypointsAndDescriptors(rgb2gray(image_2))
-    matched_features = feature_matching(descriptors1, descriptors2, method, threshold1, threshold2)
-    matched_image = cv2.drawMatches(image_1, kps1, image_2, kps2, matched_features, None, flags=cv2.DRAW_MATCHES_FLAGS_NOT_DRAW_SINGLE_POINTS)
+    # (cached by image content, so re-running with new thresholds skips SIFT)
+    kps1, descriptors1 = computeKeypointsAndDescriptors(rgb2gray(Image(image_1)).image_data, output_format=descriptor_format)
+    kps2, descriptors2 = computeKeypointsAndDescriptors(rgb2gray(Image(image_2)).image_data, output_format=descriptor_format)
+    matched_features = feature_matching(descriptors1, descriptors2, method, threshold1, threshold2, num_workers=num_workers)
+    if verification is not None:
+        # Only matches consistent with one homography / fundamental matrix are drawn
+        inlier_mask, _ = verify_matches(kps1, kps2, matched_features, verification)
+        matched_features = [match for match, is_inlier in zip(matched_features, inlier_mask) if is_inlier]
+    matched_image = cv2.drawMatches(image_1, kps1.toKeyPoints(), image_2, kps2.toKeyPoints(), matched_features, None, flags=cv2.DRAW_MATCHES_FLAGS_NOT_DRAW_SINGLE_POINTS)
     
     return matched_image
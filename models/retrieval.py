@@ -0,0 +1,198 @@
+import os
+
+import numpy as np
+from scipy import sparse
+
+from models.descriptor_index import train_kmeans
+from models.feature_store import FeatureStore
+from models.match import feature_matching, nearest_neighbors, verify_matches
+from models.sift import compute_batch
+
+
+class ImageDatabase:
+    """Bag-of-visual-words image retrieval over SIFT features, stored in one directory.
+
+    Descriptors are quantized to the nearest word of a visual vocabulary (k-means centers), and every image becomes a
+    sparse TF-IDF weighted, L2-normalized word histogram. The inverted file is a sparse matrix with one row per word
+    listing the images that contain it, so a query only touches the images that share words with it. The best candidates by cosine
+    similarity can then be re-ranked by feature_matching (and optionally verify_matches) against their stored features.
+
+    The directory holds vocabulary.npy, the word counts of every image (words.npz) and a FeatureStore of the image
+    features (features/). Changes are written by flush() or on leaving a with block.
+    """
+
+    vocabulary_file_name = "vocabulary.npy"
+    words_file_name = "words.npz"
+    features_directory_name = "features"
+
+    def __init__(self, directory: str, descriptor_dtype: str = "float32", descriptor_size: int = 128) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        vocabulary_path = os.path.join(directory, self.vocabulary_file_name)
+        self.vocabulary = np.load(vocabulary_path) if os.path.exists(vocabulary_path) else None
+        words_path = os.path.join(directory, self.words_file_name)
+        if os.path.exists(words_path):
+            with np.load(words_path) as words:
+                self.image_ids = [str(image_id) for image_id in words["image_ids"]]
+                self._word_counts = [sparse.csr_matrix((words["data"], words["indices"], words["indptr"]),
+                                                       shape=(len(self.image_ids), len(self.vocabulary)))]
+        else:
+            self.image_ids = []
+            self._word_counts = []
+        self.features = FeatureStore(os.path.join(directory, self.features_directory_name), descriptor_dtype, descriptor_size)
+        self._inverted_file = None
+        self._idf = None
+
+    def __len__(self) -> int:
+        return len(self.image_ids)
+
+    def __enter__(self) -> "ImageDatabase":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+    @property
+    def num_words(self) -> int:
+        return 0 if self.vocabulary is None else len(self.vocabulary)
+
+    def train(self, descriptor_sets, num_words: int = 1000, max_training_descriptors: int = 100000, max_iterations: int = 20,
+              seed: int = 0) -> None:
+        """Learn the visual vocabulary from a batch of (N, descriptor_size) descriptor arrays (at most max_training_descriptors of them,
+        sampled evenly). Must be called before the first add(); the vocabulary cannot change once images are added
+        """
+        if len(self):
+            raise ValueError("The vocabulary cannot be retrained once images are added")
+        descriptors = np.concatenate([np.asarray(descriptor_set, dtype=np.float32) for descriptor_set in descriptor_sets if len(descriptor_set)])
+        if descriptors.shape[1] != self.features.descriptor_size:
+            raise ValueError("Got descriptors of size {}, the feature store holds size {}".format(descriptors.shape[1], self.features.descriptor_size))
+        if len(descriptors) > max_training_descriptors:
+            descriptors = descriptors[np.random.default_rng(seed).choice(len(descriptors), max_training_descriptors, replace=False)]
+        self.vocabulary = train_kmeans(descriptors, num_words, max_iterations, seed)
+
+    def add(self, image_ids, features) -> None:
+        """Add a batch of images given as ids and (keypoints, descriptors) pairs.
+        The whole batch is checked first, so that an invalid image leaves the database unchanged
+        """
+        if self.vocabulary is None:
+            raise ValueError("train() the vocabulary before adding images")
+        image_ids, features = [str(image_id) for image_id in image_ids], list(features)
+        if len(image_ids) != len(features):
+            raise ValueError("Got {} image ids but {} feature sets".format(len(image_ids), len(features)))
+        batch_ids = set()
+        for image_id, (keypoints, descriptors) in zip(image_ids, features):
+            if image_id in self.features or image_id in batch_ids:
+                raise ValueError("Image id '{}' is already in the database or repeated in the batch".format(image_id))
+            batch_ids.add(image_id)
+            if np.size(descriptors) != len(keypoints) * self.features.descriptor_size:
+                raise ValueError("Image '{}' has {} keypoints but {} descriptor values (descriptor size {})".format(
+                    image_id, len(keypoints), np.size(descriptors), self.features.descriptor_size))
+            self.features.check_descriptors(image_id, descriptors)
+        rows = [self._word_histogram(np.reshape(descriptors, (-1, self.features.descriptor_size))) for _, descriptors in features]
+        for image_id, (keypoints, descriptors) in zip(image_ids, features):
+            self.features.add(image_id, keypoints, descriptors)
+            self.image_ids.append(image_id)
+        if rows:
+            self._word_counts.append(sparse.vstack(rows, format="csr"))
+            self._inverted_file = self._idf = None
+
+    def add_images(self, image_ids, images_or_paths, workers: int = 1, **sift_options) -> None:
+        """Compute SIFT features of a batch of images (or image paths) with compute_batch and add them"""
+        image_ids = list(image_ids)
+        results = sorted(compute_batch(images_or_paths, workers=workers, **sift_options), key=lambda result: result[0])
+        self.add(image_ids, [(keypoints, descriptors) for _, keypoints, descriptors in results])
+
+    def query(self, features, top_k: int = 10, rerank: int = 0, method: str = "SSD Ratio + Cross Check", threshold1: float = 0,
+              threshold2: float = 300, verification: str = None) -> list:
+        """Rank the database images for a batch of query (keypoints, descriptors) pairs.
+
+        For each query returns up to top_k (image_id, similarity, num_matches) tuples, best first. similarity is the
+        cosine of the TF-IDF histograms. With rerank > 0 the rerank most similar images are matched against the query
+        with feature_matching(method, threshold1, threshold2), keeping only inliers of verify_matches(verification) when
+        it is given, and re-ordered by their number of matches; num_matches is None for images that were not re-ranked.
+        The default method keeps one-to-one matches only, so that many query features matching one repeated database
+        feature do not inflate the count.
+        """
+        features = list(features)
+        if not features or not len(self):
+            return [[] for _ in features]
+        inverted_file = self._get_inverted_file()
+        query_weights = self._tf_idf(sparse.vstack([self._word_histogram(descriptors) for _, descriptors in features], format="csr"), self._idf)
+        # (queries, images) similarities; the sparse product only visits the posting lists of the words in each query
+        similarities = query_weights @ inverted_file
+
+        num_best = max(top_k, rerank)
+        rankings = []
+        for query_index, (keypoints, descriptors) in enumerate(features):
+            start, stop = similarities.indptr[query_index], similarities.indptr[query_index + 1]
+            candidates, scores = similarities.indices[start:stop], similarities.data[start:stop]
+            if 0 < num_best < len(scores):
+                # Only candidates scoring at least the num_best-th best score are sorted (all of those tied with it, so that
+                # the tie-break by image order below is the same as for a full sort)
+                is_best = scores >= -np.partition(-scores, num_best - 1)[num_best - 1]
+                candidates, scores = candidates[is_best], scores[is_best]
+            order = np.lexsort((candidates, -scores))[:num_best]
+            ranking = [(self.image_ids[candidate], float(score), None) for candidate, score in zip(candidates[order], scores[order])]
+            if rerank:
+                ranking[:rerank] = sorted(
+                    [(image_id, score, self._count_matches(keypoints, descriptors, image_id, method, threshold1, threshold2, verification))
+                     for image_id, score, _ in ranking[:rerank]], key=lambda result: -result[2])
+            rankings.append(ranking[:top_k])
+        return rankings
+
+    def query_images(self, images_or_paths, workers: int = 1, sift_options: dict = None, **query_options) -> list:
+        """Compute SIFT features of a batch of query images (or image paths) and query() with them"""
+        results = sorted(compute_batch(images_or_paths, workers=workers, **(sift_options or {})), key=lambda result: result[0])
+        return self.query([(keypoints, descriptors) for _, keypoints, descriptors in results], **query_options)
+
+    def flush(self) -> None:
+        """Write the vocabulary, word counts and features"""
+        if self.vocabulary is not None:
+            np.save(os.path.join(self.directory, self.vocabulary_file_name), self.vocabulary)
+            word_counts = self._get_word_counts()
+            words_path = os.path.join(self.directory, self.words_file_name)
+            with open(words_path + ".tmp", "wb") as words_file:
+                np.savez(words_file, image_ids=np.array(self.image_ids, dtype=str), data=word_counts.data,
+                         indices=word_counts.indices, indptr=word_counts.indptr)
+            os.replace(words_path + ".tmp", words_path)
+        self.features.flush()
+
+    def _word_histogram(self, descriptors: np.ndarray) -> sparse.csr_matrix:
+        # (1, num_words) counts of the nearest visual word of every descriptor
+        words = nearest_neighbors(descriptors, self.vocabulary, "SSD")[0][:, 0]
+        counts = np.bincount(words[words >= 0], minlength=self.num_words)
+        word_indices = np.flatnonzero(counts)
+        return sparse.csr_matrix((counts[word_indices].astype(np.float32), word_indices, [0, len(word_indices)]), shape=(1, self.num_words))
+
+    def _get_word_counts(self) -> sparse.csr_matrix:
+        if len(self._word_counts) != 1:
+            self._word_counts = [sparse.vstack(self._word_counts, format="csr") if self._word_counts
+                                 else sparse.csr_matrix((0, self.num_words), dtype=np.float32)]
+        return self._word_counts[0]
+
+    def _inverse_document_frequencies(self) -> np.ndarray:
+        # idf = log(N / number of images containing the word); words no image contains get weight 0
+        document_frequencies = np.bincount(self._get_word_counts().indices, minlength=self.num_words)
+        return np.log(len(self) / np.maximum(document_frequencies, 1)) * (document_frequencies > 0)
+
+    def _tf_idf(self, word_counts: sparse.csr_matrix, idf: np.ndarray) -> sparse.csr_matrix:
+        # Rows of word counts -> term frequency times idf, L2-normalized
+        row_sums = np.asarray(word_counts.sum(axis=1)).reshape(-1)
+        weights = sparse.diags(1 / np.maximum(row_sums, 1)) @ word_counts @ sparse.diags(idf)
+        norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).reshape(-1))
+        return (sparse.diags(1 / np.where(norms > 0, norms, 1)) @ weights).tocsr()
+
+    def _get_inverted_file(self) -> sparse.csr_matrix:
+        # (num_words, images) weights: row w is the posting list of word w. Weights change with every add (idf depends on
+        # all images), so they are rebuilt on the first query after one, together with the idf vector that queries reuse
+        if self._inverted_file is None:
+            self._idf = self._inverse_document_frequencies()
+            self._inverted_file = self._tf_idf(self._get_word_counts(), self._idf).T.tocsr()
+        return self._inverted_file
+
+    def _count_matches(self, keypoints, descriptors, image_id, method, threshold1, threshold2, verification) -> int:
+        matches = feature_matching(descriptors, self.features.descriptors(image_id), method, threshold1, threshold2)
+        if verification is None:
+            return len(matches)
+        inlier_mask, _ = verify_matches(keypoints, self.features.keypoints(image_id), matches, verification)
+        return int(np.count_nonzero(inlier_mask))
@@ -1,35 +1,759 @@
+import os
+import time
+import tracemalloc
+import weakref
 import numpy as np
 import cv2
-from functools import cmp_to_key
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, nullcontext, suppress
+from functools import lru_cache
+from multiprocessing import shared_memory
+from utils.cache import LRUCache, array_fingerprint
 
 float_tolerance = 1e-7
+# Gaussian pyramids, DoG stacks and final keypoints / descriptors of recently processed images
+sift_cache = LRUCache(max_bytes=512 * 2 ** 20)
+# keypoints per descriptor task in the parallel mode
+parallel_descriptor_chunk_size = 256
+# descriptor dtypes / normalizations accepted as output_format (see convertDescriptors)
+descriptor_output_formats = ('float32', 'uint8', 'rootsift', 'float16')
+# images submitted to the batch worker pool per worker ahead of the finished ones
+batch_tasks_per_worker = 2
+# worker pools of the parallel mode, one per number of workers, kept between calls (see getWorkerPool)
+_worker_pools = {}
 
 
-def computeKeypointsAndDescriptors(image, sigma=1.6, num_intervals=3, assumed_blur=0.5, image_border_width=5):
-    """Compute SIFT keypoints and descriptors for an input image
+def computeKeypointsAndDescriptors(image, sigma=1.6, num_intervals=3, assumed_blur=0.5, image_border_width=5, cache=sift_cache, num_workers=1, max_octaves=None, output_format='float32',
+                                   max_keypoints=None, min_response=None, spread_grid_size=None, profiler=None, executor=None):
+    """Compute SIFT keypoints and descriptors for an input image.
+    Results are cached by image content and SIFT parameters unless cache is None.
+    With num_workers > 1, the work of each DoG layer is spread across a pool of worker processes (see computeKeypointsAndDescriptorsParallel):
+    the pyramids are then built in shared memory, and executor optionally gives the pool to use instead of the one kept for num_workers.
+    max_octaves optionally caps the number of octaves of the pyramid.
+    output_format is one of descriptor_output_formats (see convertDescriptors).
+    max_keypoints, min_response and spread_grid_size set a keypoint budget (see selectKeypoints): it is applied to the localized
+    extrema before orientation assignment and again, since an extremum may get several orientations, before descriptor generation.
+    profiler optionally records per-stage statistics (see SIFTProfiler)
     """
+    if output_format not in descriptor_output_formats:
+        raise ValueError("output_format must be one of {}".format(descriptor_output_formats))
     image = image.astype('float32')
-    base_image = generateBaseImage(image, sigma, assumed_blur)
-    num_octaves = computeNumberOfOctaves(base_image.shape)
-    gaussian_kernels = generateGaussianKernels(sigma, num_intervals)
+    image_hash = array_fingerprint(image) if cache is not None else None
+    keypoint_budget = dict(max_keypoints=max_keypoints, min_response=min_response, spread_grid_size=spread_grid_size)
+    features_key = ('features', image_hash, sigma, num_intervals, assumed_blur, max_octaves, image_border_width,
+                    max_keypoints, min_response, spread_grid_size)
+    if cache is not None:
+        cached_features = cache.get(features_key)
+        if profiler is not None:
+            profiler.count('cache', hits=cached_features is not None, misses=cached_features is None)
+        if cached_features is not None:
+            # every format is derived from the cached uint8 descriptors into a new array
+            return cached_features[0].copy(), convertDescriptors(cached_features[1], output_format)
+
+    with profileStage(profiler, 'pyramid'):
+        gaussian_images, dog_images = generateScaleSpace(image, sigma, num_intervals, assumed_blur, cache, image_hash, max_octaves,
+                                                         allocate=allocateSharedImages if num_workers > 1 else None)
+    if profiler is not None:
+        profiler.count('pyramid', octaves=len(gaussian_images))
+    if num_workers > 1:
+        keypoints, descriptors = computeKeypointsAndDescriptorsParallel(
+            gaussian_images, dog_images, num_intervals, sigma, image_border_width, num_workers, **keypoint_budget, profiler=profiler,
+            executor=executor)
+    else:
+        # gradient maps of each Gaussian image are shared by orientation assignment and descriptor generation
+        gradient_maps = {}
+        keypoints = findScaleSpaceExtrema(
+            gaussian_images, dog_images, num_intervals, sigma, image_border_width, gradient_maps=gradient_maps, **keypoint_budget, profiler=profiler)
+        with profileStage(profiler, 'duplicates'):
+            keypoints = removeDuplicateKeypoints(keypoints)
+            keypoints = convertKeypointsToInputImageSize(keypoints)
+            keypoints = selectKeypoints(keypoints, image.shape, **keypoint_budget)
+        with profileStage(profiler, 'descriptors'):
+            descriptors = generateDescriptors(keypoints, gaussian_images, gradient_maps=gradient_maps)
+        if profiler is not None:
+            profiler.count('duplicates', keypoints=len(keypoints))
+            profiler.count('descriptors', keypoints=len(keypoints))
+
+    if cache is not None:
+        # descriptor values are integers in [0, 255], so uint8 keeps them exactly in a quarter of the bytes
+        cached_descriptors = descriptors.astype('uint8')
+        cache.put(features_key, (keypoints.copy(), cached_descriptors), keypoints.nbytes + cached_descriptors.nbytes)
+    return keypoints, convertDescriptors(descriptors, output_format)
+
+
+def convertDescriptors(descriptors, output_format='float32'):
+    """Convert descriptors, whose values are integers in [0, 255] (float32 or uint8), to one of descriptor_output_formats.
+    uint8 and float16 hold the same values in a quarter / half of the bytes; rootsift is the float32 square root
+    of the L1-normalized descriptor (Arandjelovic and Zisserman), so that Euclidean distances compare like the Hellinger kernel
+    """
+    if output_format in ('uint8', 'float16'):
+        return descriptors.astype(output_format)
+    descriptors = np.asarray(descriptors, dtype='float32')
+    if output_format == 'float32':
+        return descriptors
+    if output_format == 'rootsift':
+        l1_norms = np.maximum(np.abs(descriptors).sum(axis=1, keepdims=True), float_tolerance)
+        return np.sqrt(descriptors / l1_norms).astype('float32')
+    raise ValueError("output_format must be one of {}".format(descriptor_output_formats))
+
+
+class SIFTProfiler:
+    """Per-stage statistics of one or more SIFT runs: wall time, calls, item counts (candidates, keypoints, ...) and peak array bytes.
+    Pass an instance as the profiler of computeKeypointsAndDescriptors and read report() afterwards; with the default profiler=None
+    nothing is recorded. Peak bytes are the largest increase of traced memory (tracemalloc) during a call of the stage.
+    Tracing makes the stages noticeably slower, so use trace_memory=False when only the timings matter.
+    Work done in worker processes is timed but its memory is not traced
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def _statistics(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = {'seconds': 0., 'calls': 0, 'counts': {}, 'peak_bytes': 0}
+        return self.stages[stage]
+
+    @contextmanager
+    def stage(self, stage):
+        statistics = self._statistics(stage)
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            statistics['seconds'] += time.perf_counter() - start_time
+            statistics['calls'] += 1
+            if self.trace_memory:
+                statistics['peak_bytes'] = max(statistics['peak_bytes'], tracemalloc.get_traced_memory()[1] - start_bytes)
+            if started_tracing:
+                tracemalloc.stop()
+
+    def count(self, stage, **counts):
+        stage_counts = self._statistics(stage)['counts']
+        for name, value in counts.items():
+            stage_counts[name] = stage_counts.get(name, 0) + int(value)
+
+    def reset(self):
+        self.stages.clear()
+
+    def report(self):
+        """Return {'stages': {stage: {'seconds', 'calls', 'counts', 'peak_bytes'}}, 'total_seconds'} with stages in pipeline order
+        """
+        stages = {stage: dict(statistics, counts=dict(statistics['counts'])) for stage, statistics in self.stages.items()}
+        return {'stages': stages, 'total_seconds': sum(statistics['seconds'] for statistics in stages.values())}
+
+    def formatReport(self):
+        """Return the report as a text table, one line per stage
+        """
+        report = self.report()
+        lines = ['{:<13}{:>10}{:>7}{:>10}  {}'.format('stage', 'ms', 'calls', 'peak MiB' if self.trace_memory else '', 'counts')]
+        for stage, statistics in report['stages'].items():
+            counts = ', '.join('{}={}'.format(name, value) for name, value in statistics['counts'].items())
+            peak = '{:.1f}'.format(statistics['peak_bytes'] / 2 ** 20) if self.trace_memory else ''
+            lines.append('{:<13}{:>10.1f}{:>7}{:>10}  {}'.format(stage, statistics['seconds'] * 1000, statistics['calls'], peak, counts))
+        lines.append('{:<13}{:>10.1f}'.format('total', report['total_seconds'] * 1000))
+        return '\n'.join(lines)
+
+
+def profileStage(profiler, stage):
+    """Context manager timing a stage on profiler, or doing nothing when profiler is None
+    """
+    return nullcontext() if profiler is None else profiler.stage(stage)
+
+
+def generateScaleSpace(image, sigma, num_intervals, assumed_blur, cache=None, image_hash=None, max_octaves=None, allocate=None):
+    """Generate the Gaussian and DoG pyramids of a float32 input image, reusing cached pyramids of the same image content when available.
+    allocate(shape) optionally creates the float32 array of each octave (e.g. allocateSharedImages), np.empty by default
+    """
+    allocate = allocate or allocateImages
+    pyramid_key = ('pyramid', image_hash, sigma, num_intervals, assumed_blur, max_octaves)
+    if cache is not None:
+        cached_pyramid = cache.get(pyramid_key)
+        if cached_pyramid is not None:
+            return cached_pyramid
+
+    # the base image is blurred straight into the first slice of the first octave's buffer
+    first_octave = allocate((num_intervals + 3, 2 * image.shape[0], 2 * image.shape[1]))
+    generateBaseImage(image, sigma, assumed_blur, dst=first_octave[0])
+    num_octaves = computeNumberOfOctaves(first_octave.shape[1:])
+    if max_octaves is not None:
+        num_octaves = min(num_octaves, max_octaves)
+    separable_kernels = generateSeparableGaussianKernels(sigma, num_intervals)
     gaussian_images = generateGaussianImages(
-        base_image, num_octaves, gaussian_kernels)
-    dog_images = generateDoGImages(gaussian_images)
-    keypoints = findScaleSpaceExtrema(
-        gaussian_images, dog_images, num_intervals, sigma, image_border_width)
-    keypoints = removeDuplicateKeypoints(keypoints)
-    keypoints = convertKeypointsToInputImageSize(keypoints)
-    descriptors = generateDescriptors(keypoints, gaussian_images)
+        first_octave, num_octaves, separable_kernels, allocate)
+    dog_images = generateDoGImages(gaussian_images, allocate)
+
+    if cache is not None:
+        pyramid_nbytes = sum(images_in_octave.nbytes for images_in_octave in gaussian_images + dog_images)
+        cache.put(pyramid_key, (gaussian_images, dog_images), pyramid_nbytes)
+    return gaussian_images, dog_images
+
+
+def compute_batch(images_or_paths, workers=1, output_dir=None, sigma=1.6, num_intervals=3, assumed_blur=0.5, image_border_width=5, max_octaves=None, output_format='float32',
+                  max_keypoints=None, min_response=None, spread_grid_size=None):
+    """Compute SIFT keypoints and descriptors for many images, yielding results as soon as each image is done (not in input order).
+    Items are grayscale images or image file paths; paths are read by the worker that processes them.
+    With workers > 1 the images are spread over one pool of worker processes kept for the whole batch, so each worker
+    builds its Gaussian kernels once. Per-image results are not cached.
+    Yield (index, keypoints, descriptors), or (index, file_path) when output_dir is given and the features are written
+    to <output_dir> with saveFeatures instead of being sent back
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    parameters = dict(sigma=sigma, num_intervals=num_intervals, assumed_blur=assumed_blur,
+                      image_border_width=image_border_width, max_octaves=max_octaves, output_format=output_format,
+                      max_keypoints=max_keypoints, min_response=min_response, spread_grid_size=spread_grid_size)
+    items = enumerate(images_or_paths)
+    if workers <= 1:
+        for index, image_or_path in items:
+            yield _computeBatchItem(index, image_or_path, parameters, output_dir)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # only a few images per worker are in flight, so that long (lazy) batches are not all read or pickled at once
+        pending = set()
+        for index, image_or_path in items:
+            pending.add(executor.submit(_computeBatchItem, index, image_or_path, parameters, output_dir))
+            if len(pending) >= workers * batch_tasks_per_worker:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+
+def _computeBatchItem(index, image_or_path, parameters, output_dir):
+    if isinstance(image_or_path, (str, os.PathLike)):
+        image = cv2.imread(os.fspath(image_or_path), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise ValueError("Could not read image '{}'".format(image_or_path))
+        name = '{:06d}_{}'.format(index, os.path.splitext(os.path.basename(image_or_path))[0])
+    else:
+        image = image_or_path
+        name = '{:06d}'.format(index)
+    keypoints, descriptors = computeKeypointsAndDescriptors(image, cache=None, **parameters)
+    if output_dir is None:
+        return index, keypoints, descriptors
+    file_path = os.path.join(output_dir, name + '.npz')
+    saveFeatures(file_path, keypoints, descriptors)
+    return index, file_path
+
+
+def saveFeatures(file_path, keypoints, descriptors):
+    """Write a KeypointTable and its descriptors to an .npz file, one array per keypoint column
+    """
+    np.savez(file_path, descriptors=descriptors, **{column: getattr(keypoints, column) for column in KeypointTable.columns})
+
+
+def loadFeatures(file_path):
+    """Read keypoints and descriptors written by saveFeatures
+    """
+    with np.load(file_path) as features:
+        return KeypointTable(**{column: features[column] for column in KeypointTable.columns}), features['descriptors']
+
+
+def computeKeypointsAndDescriptorsTiled(image, tile_size=1024, max_octaves=4, halo=None, sigma=1.6, num_intervals=3, assumed_blur=0.5, image_border_width=5, num_workers=1):
+    """Compute SIFT keypoints and descriptors of a large image tile by tile, so that memory stays proportional to the tile size instead of the image size.
+    Each tile is processed with an overlapping halo (see computeTileHalo) and only the keypoints of its core are kept, in input image coordinates.
+    Results are close to, but not identical with, computeKeypointsAndDescriptors(image, max_octaves=max_octaves)
+    """
+    keypoints = []
+    descriptors = []
+    for _, tile_keypoints, tile_descriptors in iterateTiledKeypointsAndDescriptors(
+            image, tile_size, max_octaves, halo, sigma, num_intervals, assumed_blur, image_border_width, num_workers):
+        keypoints.append(tile_keypoints)
+        descriptors.append(tile_descriptors)
+    return KeypointTable.concatenate(keypoints), np.concatenate(descriptors) if descriptors else np.zeros((0, 128), dtype='float32')
+
+
+def iterateTiledKeypointsAndDescriptors(image, tile_size=1024, max_octaves=4, halo=None, sigma=1.6, num_intervals=3, assumed_blur=0.5, image_border_width=5, num_workers=1):
+    """Stream version of computeKeypointsAndDescriptorsTiled: yield (tile_box, keypoints, descriptors) for one tile at a time.
+    image may be a np.memmap, in which case only the current tile (with its halo) is read into memory
+    """
+    if halo is None:
+        halo = computeTileHalo(sigma, num_intervals, max_octaves, image_border_width)
+    for tile_box in generateTiles(image.shape[:2], tile_size):
+        tile_keypoints, tile_descriptors = computeTileKeypointsAndDescriptors(
+            image, tile_box, halo, max_octaves, sigma, num_intervals, assumed_blur, image_border_width, num_workers)
+        yield tile_box, tile_keypoints, tile_descriptors
+
+
+def generateTiles(image_shape, tile_size):
+    """Split an image into non-overlapping (row_start, row_end, col_start, col_end) tile boxes of at most tile_size x tile_size pixels
+    """
+    num_rows, num_cols = image_shape
+    return [(row_start, min(row_start + tile_size, num_rows), col_start, min(col_start + tile_size, num_cols))
+            for row_start in range(0, num_rows, tile_size) for col_start in range(0, num_cols, tile_size)]
+
+
+def computeTileHalo(sigma, num_intervals, max_octaves, image_border_width, window_width=4, scale_multiplier=3):
+    """Compute the overlap (in input image pixels) a tile needs so that keypoints of its core see the same neighborhood as in the full image:
+    the descriptor window of the largest keypoint of the top octave plus the support of the blurriest Gaussian image and the border width at that octave
+    """
+    # pixel size of the top octave in input image pixels (the base image is upsampled by 2)
+    octave_pixel_size = 2. ** (max_octaves - 2)
+    # compare with keypoint size computation in createKeypointsFromExtrema() and convertKeypointsToInputImageSize()
+    max_keypoint_size = sigma * (2 ** ((num_intervals + 0.5) / num_intervals)) * octave_pixel_size
+    # compare with half_width computation in computeDescriptorsForKeypoints()
+    descriptor_radius = scale_multiplier * 0.5 * max_keypoint_size * np.sqrt(2) * (window_width + 1) * 0.5
+    # 3 sigma support of the blurriest Gaussian image of the top octave
+    blur_radius = 3 * sigma * (2 ** ((num_intervals + 2) / num_intervals)) * octave_pixel_size
+    return int(np.ceil(descriptor_radius + blur_radius + image_border_width * octave_pixel_size))
+
+
+def computeTileKeypointsAndDescriptors(image, tile_box, halo, max_octaves=4, sigma=1.6, num_intervals=3, assumed_blur=0.5, image_border_width=5, num_workers=1):
+    """Compute the keypoints and descriptors of one tile: run SIFT on the tile plus its halo, drop keypoints that fall inside the halo and
+    move the remaining ones to input image coordinates
+    """
+    row_start, row_end, col_start, col_end = tile_box
+    halo_row_start, halo_col_start = max(row_start - halo, 0), max(col_start - halo, 0)
+    halo_row_end, halo_col_end = min(row_end + halo, image.shape[0]), min(col_end + halo, image.shape[1])
+    tile_image = np.asarray(image[halo_row_start:halo_row_end, halo_col_start:halo_col_end])
+    # tiles are not cached, which would keep every tile's pyramid in memory
+    keypoints, descriptors = computeKeypointsAndDescriptors(
+        tile_image, sigma, num_intervals, assumed_blur, image_border_width, cache=None, num_workers=num_workers, max_octaves=max_octaves)
+
+    keypoints.x += halo_col_start
+    keypoints.y += halo_row_start
+    is_in_core = (keypoints.y >= row_start) & (keypoints.y < row_end) & (keypoints.x >= col_start) & (keypoints.x < col_end)
+    return keypoints[is_in_core], descriptors[is_in_core]
+
+
+def streamKeypointsAndDescriptors(frames, tile_size=64, change_threshold=0, sigma=1.6, num_intervals=3, assumed_blur=0.5, image_border_width=5, max_octaves=None):
+    """Yield (keypoints, descriptors) for each grayscale frame of an iterable (e.g. a generator reading a video),
+    recomputing only what the tiles that changed since the previous frame affect (see StreamingSIFT)
+    """
+    streaming_sift = StreamingSIFT(tile_size, change_threshold, sigma, num_intervals, assumed_blur, image_border_width, max_octaves)
+    for frame in frames:
+        yield streaming_sift.update(frame)
+
+
+class StreamingSIFT:
+    """Incremental SIFT for consecutive frames of a fixed camera.
+    Each frame is compared with the image the current features were computed from (the reference) in tile_size x tile_size tiles;
+    tiles with a pixel differing by more than change_threshold are copied into the reference. Then only the parts of the pyramid
+    those tiles reach are rebuilt, extrema are searched again only around them, and orientations and descriptors are recomputed
+    only for keypoints whose windows overlap changed Gaussian pixels. All other keypoints and descriptors are reused.
+    With change_threshold=0 the output equals computeKeypointsAndDescriptors(frame, cache=None); with a larger threshold it equals
+    the features of the reference, which differs from the frame by at most change_threshold in unchanged tiles
+    """
+
+    def __init__(self, tile_size=64, change_threshold=0, sigma=1.6, num_intervals=3, assumed_blur=0.5, image_border_width=5, max_octaves=None, contrast_threshold=0.04):
+        self.tile_size = tile_size
+        self.change_threshold = change_threshold
+        self.sigma = sigma
+        self.num_intervals = num_intervals
+        self.assumed_blur = assumed_blur
+        self.image_border_width = image_border_width
+        self.max_octaves = max_octaves
+        self.contrast_threshold = contrast_threshold
+        self.reset()
+
+    def reset(self):
+        """Forget the reference, so that the next frame is computed in full
+        """
+        self.reference = None
+        self.gaussian_images = self.dog_images = None
+        self.gradient_maps = {}
+        # candidate extrema (rows, cols) of each (octave_index, image_index) DoG layer
+        self.candidates = {}
+        # keypoints with orientations and their descriptors (valid where has_descriptor) of the last frame, and the rows of
+        # oriented_keypoints that each localized keypoint of the last frame produced
+        self.oriented_keypoints = KeypointTable()
+        self.oriented_descriptors = np.zeros((0, 128), dtype='float32')
+        self.has_descriptor = np.zeros(0, dtype=bool)
+        self.localized_rows = {}
+        self.keypoints, self.descriptors = KeypointTable(), np.zeros((0, 128), dtype='float32')
+        # (row_start, row_end, col_start, col_end) frame boxes recomputed by the last update() and how many oriented keypoints it reused
+        self.changed_boxes = []
+        self.num_reused_keypoints = 0
+
+    def update(self, frame):
+        """Return the keypoints and descriptors of the next frame
+        """
+        frame = np.asarray(frame).astype('float32')
+        if self.reference is None or self.reference.shape != frame.shape:
+            self.reset()
+            self.reference = frame.copy()
+            self.gaussian_images, self.dog_images = generateScaleSpace(
+                self.reference, self.sigma, self.num_intervals, self.assumed_blur, max_octaves=self.max_octaves)
+            self.changed_boxes = [(0, frame.shape[0], 0, frame.shape[1])]
+            changed_gaussian_boxes = changed_dog_boxes = None
+        else:
+            self.changed_boxes = self.findChangedBoxes(frame)
+            if not self.changed_boxes:
+                self.num_reused_keypoints = len(self.oriented_keypoints)
+                return self.keypoints.copy(), self.descriptors.copy()
+            for row_start, row_end, col_start, col_end in self.changed_boxes:
+                self.reference[row_start:row_end, col_start:col_end] = frame[row_start:row_end, col_start:col_end]
+            changed_gaussian_boxes, changed_dog_boxes = self.updateScaleSpace(self.changed_boxes)
+
+        localized_keypoints = self.updateLocalizedKeypoints(changed_dog_boxes)
+        oriented_keypoints, oriented_descriptors, has_descriptor = self.updateOrientations(localized_keypoints, changed_gaussian_boxes)
+
+        unique_indices = findUniqueKeypoints(oriented_keypoints)
+        keypoints = convertKeypointsToInputImageSize(oriented_keypoints[unique_indices])
+        missing = np.nonzero(~has_descriptor[unique_indices])[0]
+        oriented_descriptors[unique_indices[missing]] = generateDescriptors(keypoints[missing], self.gaussian_images, gradient_maps=self.gradient_maps)
+        has_descriptor[unique_indices[missing]] = True
+        self.oriented_descriptors, self.has_descriptor = oriented_descriptors, has_descriptor
+        self.keypoints, self.descriptors = keypoints, oriented_descriptors[unique_indices]
+        return self.keypoints.copy(), self.descriptors.copy()
+
+    def findChangedBoxes(self, frame):
+        """Return the bounding boxes (in frame pixels) of the connected groups of tiles that differ from the reference
+        """
+        is_changed = cv2.absdiff(frame, self.reference) > self.change_threshold
+        row_starts = np.arange(0, frame.shape[0], self.tile_size)
+        col_starts = np.arange(0, frame.shape[1], self.tile_size)
+        changed_tiles = np.logical_or.reduceat(np.logical_or.reduceat(is_changed, row_starts, axis=0), col_starts, axis=1)
+        num_groups, _, group_stats, _ = cv2.connectedComponentsWithStats(changed_tiles.astype('uint8'), connectivity=8)
+        changed_boxes = []
+        for tile_col, tile_row, num_tile_cols, num_tile_rows, _ in group_stats[1:num_groups].tolist():
+            changed_boxes.append((tile_row * self.tile_size, min((tile_row + num_tile_rows) * self.tile_size, frame.shape[0]),
+                                  tile_col * self.tile_size, min((tile_col + num_tile_cols) * self.tile_size, frame.shape[1])))
+        return changed_boxes
+
+    def updateScaleSpace(self, changed_boxes):
+        """Rebuild the Gaussian and DoG pyramids in the regions that the changed reference boxes reach, through the same
+        operations as generateScaleSpace on crops large enough for the rebuilt pixels to be identical.
+        Return the rebuilt boxes of each (octave_index, image_index) Gaussian image and of each octave's DoG images
+        """
+        separable_kernels = generateSeparableGaussianKernels(self.sigma, self.num_intervals)
+        base_kernel_size = int(np.round(np.sqrt(max((self.sigma ** 2) - ((2 * self.assumed_blur) ** 2), 0.01)) * 4 * 2 + 1)) | 1
+        base_radius = base_kernel_size // 2
+        base_shape = self.gaussian_images[0].shape[1:]
+        changed_gaussian_boxes = {}
+        changed_dog_boxes = {}
+
+        octave_boxes = []
+        for row_start, row_end, col_start, col_end in changed_boxes:
+            # pixels of the upsampled image that changed, then of the blurred base image
+            base_box = expandBox((2 * row_start - 1, 2 * row_end + 1, 2 * col_start - 1, 2 * col_end + 1), base_radius, base_shape)
+            # the upsampled crop must be exact on base_box plus the blur radius; its first and last row / column are not
+            crop_box = (max((base_box[0] - base_radius - 1) // 2 - 1, 0), min((base_box[1] + base_radius + 1) // 2 + 2, self.reference.shape[0]),
+                        max((base_box[2] - base_radius - 1) // 2 - 1, 0), min((base_box[3] + base_radius + 1) // 2 + 2, self.reference.shape[1]))
+            base_crop = generateBaseImage(np.ascontiguousarray(cropBox(self.reference, crop_box)), self.sigma, self.assumed_blur)
+            cropBox(self.gaussian_images[0][0], base_box)[:] = cropBox(base_crop, shiftBox(base_box, 2 * crop_box[0], 2 * crop_box[2]))
+            octave_boxes.append(base_box)
+
+        for octave_index, gaussian_images_in_octave in enumerate(self.gaussian_images):
+            image_shape = gaussian_images_in_octave.shape[1:]
+            changed_gaussian_boxes[octave_index, 0] = list(octave_boxes)
+            for image_index, kernel in enumerate(separable_kernels, start=1):
+                radius = len(kernel) // 2
+                changed_gaussian_boxes[octave_index, image_index] = []
+                for box in changed_gaussian_boxes[octave_index, image_index - 1]:
+                    box = expandBox(box, radius, image_shape)
+                    source_box = expandBox(box, radius, image_shape)
+                    filtered_crop = cv2.sepFilter2D(np.ascontiguousarray(cropBox(gaussian_images_in_octave[image_index - 1], source_box)), -1, kernel, kernel)
+                    cropBox(gaussian_images_in_octave[image_index], box)[:] = cropBox(filtered_crop, shiftBox(box, source_box[0], source_box[2]))
+                    changed_gaussian_boxes[octave_index, image_index].append(box)
+            # blurrier images changed in larger boxes, so the boxes of the last image cover every changed DoG image
+            changed_dog_boxes[octave_index] = changed_gaussian_boxes[octave_index, len(separable_kernels)]
+            for row_start, row_end, col_start, col_end in changed_dog_boxes[octave_index]:
+                np.subtract(gaussian_images_in_octave[1:, row_start:row_end, col_start:col_end], gaussian_images_in_octave[:-1, row_start:row_end, col_start:col_end],
+                            out=self.dog_images[octave_index][:, row_start:row_end, col_start:col_end])
+
+            if octave_index + 1 < len(self.gaussian_images):
+                # the next octave's base is a cheap nearest-neighbor resize, redone in full; its changed boxes are mapped conservatively
+                next_images = self.gaussian_images[octave_index + 1]
+                octave_base = gaussian_images_in_octave[-3]
+                cv2.resize(octave_base, next_images.shape[:0:-1], dst=next_images[0], interpolation=cv2.INTER_NEAREST)
+                octave_boxes = [expandBox((row_start // 2, -(-row_end // 2), col_start // 2, -(-col_end // 2)), 1, next_images.shape[1:])
+                                for row_start, row_end, col_start, col_end in changed_gaussian_boxes[octave_index, len(separable_kernels) - 2]]
+
+        # gradient maps of changed Gaussian images are rebuilt in the changed boxes (plus the pixel their central differences reach)
+        for layer, gradient_maps in self.gradient_maps.items():
+            image = self.gaussian_images[layer[0]][layer[1]]
+            for box in changed_gaussian_boxes[layer]:
+                box = expandBox(box, 1, image.shape)
+                source_box = expandBox(box, 1, image.shape)
+                crop_maps = computeGradientMaps(np.ascontiguousarray(cropBox(image, source_box)))
+                for gradient_map, crop_map in zip(gradient_maps, crop_maps):
+                    cropBox(gradient_map, box)[:] = cropBox(crop_map, shiftBox(box, source_box[0], source_box[2]))
+        return changed_gaussian_boxes, changed_dog_boxes
+
+    def updateLocalizedKeypoints(self, changed_dog_boxes):
+        """Search candidate extrema again around the changed DoG boxes (everywhere when changed_dog_boxes is None) and localize all candidates
+        """
+        threshold = np.floor(0.5 * self.contrast_threshold / self.num_intervals * 255)
+        candidates = []
+        for octave_index, dog_images_in_octave in enumerate(self.dog_images):
+            image_shape = dog_images_in_octave.shape[1:]
+            for image_index in range(1, len(dog_images_in_octave) - 1):
+                layer_images = dog_images_in_octave[image_index - 1:image_index + 2]
+                if changed_dog_boxes is None:
+                    rows, cols = findPixelExtremaInLayer(*layer_images, threshold, self.image_border_width)
+                else:
+                    rows, cols = self.candidates[octave_index, image_index]
+                    is_kept = np.ones(len(rows), dtype=bool)
+                    linear_indices = [None]
+                    for box in changed_dog_boxes[octave_index]:
+                        # an extremum depends on its 3x3x3 neighborhood only
+                        box = expandBox(box, 1, image_shape)
+                        is_kept &= ~((rows >= box[0]) & (rows < box[1]) & (cols >= box[2]) & (cols < box[3]))
+                        source_box = expandBox(box, 1, image_shape)
+                        box_rows, box_cols = findPixelExtremaInLayer(*[cropBox(image, source_box) for image in layer_images], threshold, 1)
+                        box_rows, box_cols = box_rows + source_box[0], box_cols + source_box[2]
+                        is_valid = (box_rows >= max(box[0], self.image_border_width)) & (box_rows < min(box[1], image_shape[0] - self.image_border_width)) & \
+                                   (box_cols >= max(box[2], self.image_border_width)) & (box_cols < min(box[3], image_shape[1] - self.image_border_width))
+                        linear_indices.append(box_rows[is_valid] * image_shape[1] + box_cols[is_valid])
+                    linear_indices[0] = rows[is_kept] * image_shape[1] + cols[is_kept]
+                    # np.unique also restores the row-major order of a full scan
+                    rows, cols = np.divmod(np.unique(np.concatenate(linear_indices)), image_shape[1])
+                self.candidates[octave_index, image_index] = (rows, cols)
+                candidates.append(np.stack([np.full(len(rows), octave_index), np.full(len(rows), image_index), rows, cols], axis=1))
+        candidates = np.concatenate(candidates) if candidates else np.zeros((0, 4), dtype=int)
+        return localizeExtremaViaQuadraticFit(candidates, self.dog_images, self.num_intervals, self.sigma, self.contrast_threshold, self.image_border_width)
+
+    def updateOrientations(self, localized_keypoints, changed_gaussian_boxes, window_width=4, scale_multiplier=3):
+        """Assign orientations to localized keypoints, reusing the orientations (and descriptors) of the last frame for keypoints that were
+        localized identically and whose orientation and descriptor windows do not overlap a changed box of their Gaussian image.
+        Return the keypoints with orientations, their descriptors and the mask of descriptors that are already valid
+        """
+        localized_keys = [tuple(row) for row in np.stack([
+            localized_keypoints.x.view('int32'), localized_keypoints.y.view('int32'), localized_keypoints.size.view('int32'),
+            localized_keypoints.response.view('int32'), localized_keypoints.octave, localized_keypoints.layer, localized_keypoints.layer_offset], axis=1).tolist()]
+        is_reused = np.array([key in self.localized_rows for key in localized_keys], dtype=bool)
+        if changed_gaussian_boxes is not None and len(localized_keypoints):
+            # compare with half_width computation in computeDescriptorsForKeypoints(), which has the largest window
+            octave_scales = 2. ** -localized_keypoints.octave.astype('float64')
+            radii = np.ceil(scale_multiplier * 0.5 * localized_keypoints.size * octave_scales * np.sqrt(2) * (window_width + 1) * 0.5) + 2
+            centers_x = np.round(localized_keypoints.x * octave_scales)
+            centers_y = np.round(localized_keypoints.y * octave_scales)
+            for octave_index, image_index, keypoint_indices in groupKeypointsByLayer(localized_keypoints):
+                for row_start, row_end, col_start, col_end in changed_gaussian_boxes[octave_index, image_index]:
+                    radius, x, y = radii[keypoint_indices], centers_x[keypoint_indices], centers_y[keypoint_indices]
+                    is_reused[keypoint_indices] &= (y + radius < row_start - 1) | (y - radius >= row_end + 1) | \
+                                                   (x + radius < col_start - 1) | (x - radius >= col_end + 1)
+        else:
+            is_reused[:] = False
+
+        reused_indices = np.nonzero(is_reused)[0]
+        reused_ranges = np.array([self.localized_rows[localized_keys[index]] for index in reused_indices.tolist()], dtype=int).reshape(-1, 2)
+        reused_rows = np.concatenate([np.arange(start, stop) for start, stop in reused_ranges.tolist()] + [np.zeros(0, dtype=int)])
+        keypoints_with_orientations = [self.oriented_keypoints[reused_rows]]
+        source_indices = [np.repeat(reused_indices, reused_ranges[:, 1] - reused_ranges[:, 0])]
+        computed_indices = np.nonzero(~is_reused)[0]
+        for octave_index, image_index, keypoint_indices in groupKeypointsByLayer(localized_keypoints[computed_indices]):
+            oriented_keypoints, oriented_sources = computeOrientationsForKeypoints(
+                localized_keypoints[computed_indices[keypoint_indices]], octave_index, self.gaussian_images[octave_index][image_index],
+                gradient_maps=getGradientMaps(self.gradient_maps, self.gaussian_images, octave_index, image_index))
+            keypoints_with_orientations.append(oriented_keypoints)
+            source_indices.append(computed_indices[keypoint_indices][oriented_sources])
+
+        order = np.argsort(np.concatenate(source_indices), kind='stable')
+        oriented_keypoints = KeypointTable.concatenate(keypoints_with_orientations)[order]
+        num_computed = len(oriented_keypoints) - len(reused_rows)
+        oriented_descriptors = np.concatenate([self.oriented_descriptors[reused_rows], np.zeros((num_computed, 128), dtype='float32')])[order]
+        has_descriptor = np.concatenate([self.has_descriptor[reused_rows], np.zeros(num_computed, dtype=bool)])[order]
+
+        sources = np.concatenate(source_indices)[order]
+        row_starts = np.searchsorted(sources, np.arange(len(localized_keypoints)), side='left')
+        row_stops = np.searchsorted(sources, np.arange(len(localized_keypoints)), side='right')
+        self.localized_rows = dict(zip(localized_keys, zip(row_starts.tolist(), row_stops.tolist())))
+        self.oriented_keypoints = oriented_keypoints
+        self.num_reused_keypoints = len(reused_rows)
+        return oriented_keypoints, oriented_descriptors, has_descriptor
+
+
+def expandBox(box, margin, image_shape):
+    """Grow a (row_start, row_end, col_start, col_end) box by margin pixels on each side, clipped to the image
+    """
+    row_start, row_end, col_start, col_end = box
+    return (max(row_start - margin, 0), min(row_end + margin, image_shape[0]), max(col_start - margin, 0), min(col_end + margin, image_shape[1]))
+
+
+def shiftBox(box, row_offset, col_offset):
+    return (box[0] - row_offset, box[1] - row_offset, box[2] - col_offset, box[3] - col_offset)
+
+
+def cropBox(image, box):
+    return image[box[0]:box[1], box[2]:box[3]]
+
+
+def computeKeypointsAndDescriptorsParallel(gaussian_images, dog_images, num_intervals, sigma, image_border_width, num_workers,
+                                           max_keypoints=None, min_response=None, spread_grid_size=None, profiler=None, executor=None):
+    """Compute keypoints and descriptors from existing pyramids with a pool of worker processes.
+    The pyramids are placed in shared memory (octaves that already are, see allocateSharedImages, are not copied); workers localize
+    extrema per DoG layer, assign orientations per Gaussian image and compute descriptors per chunk of keypoints of the same layer.
+    The keypoint budget is applied in this process between those stages.
+    The pool is executor if given, otherwise the one kept for num_workers (see getWorkerPool), so repeated calls do not start new
+    processes, and workers keep pyramids (and their gradient maps) attached as long as the same shared pyramids are passed.
+    Results are merged in layer order, so the output is identical to the single-process path
+    """
+    keypoint_budget = dict(max_keypoints=max_keypoints, min_response=min_response, spread_grid_size=spread_grid_size)
+    # the shared copies (if any) must stay alive until the workers are done
+    shared_copies, scale_space_description = shareScaleSpace(gaussian_images, dog_images)
+    if executor is None:
+        executor = getWorkerPool(num_workers)
+    try:
+        dog_layers = [(octave_index, image_index) for octave_index, dog_images_in_octave in enumerate(dog_images)
+                      for image_index in range(1, len(dog_images_in_octave) - 1)]
+        # octave 0 holds most of the work, so it is split per layer rather than per octave
+        with profileStage(profiler, 'localization'):
+            extrema_tasks = [executor.submit(_localizeScaleSpaceExtremaInSharedLayer, scale_space_description, layer,
+                                             num_intervals, sigma, image_border_width) for layer in dog_layers]
+            localized_keypoints = KeypointTable.concatenate([task.result() for task in extrema_tasks])
+        with profileStage(profiler, 'selection'):
+            localized_keypoints = selectKeypoints(localized_keypoints, dog_images[0][0].shape, **keypoint_budget)
+
+        with profileStage(profiler, 'orientation'):
+            orientation_tasks = [(keypoint_indices, executor.submit(
+                _computeOrientationsInSharedLayer, scale_space_description, (octave, layer), localized_keypoints[keypoint_indices]))
+                for octave, layer, keypoint_indices in groupKeypointsByLayer(localized_keypoints)]
+            keypoints_with_orientations = []
+            source_indices = []
+            for keypoint_indices, task in orientation_tasks:
+                oriented_keypoints, oriented_sources = task.result()
+                keypoints_with_orientations.append(oriented_keypoints)
+                source_indices.append(keypoint_indices[oriented_sources])
+            keypoints = mergeOrientedKeypoints(keypoints_with_orientations, source_indices)
+        if profiler is not None:
+            profiler.count('localization', layers=len(dog_layers), keypoints=len(localized_keypoints))
+            profiler.count('orientation', keypoints=len(keypoints))
+        with profileStage(profiler, 'duplicates'):
+            keypoints = removeDuplicateKeypoints(keypoints)
+            keypoints = convertKeypointsToInputImageSize(keypoints)
+            keypoints = selectKeypoints(keypoints, tuple(dimension // 2 for dimension in dog_images[0][0].shape), **keypoint_budget)
+
+        with profileStage(profiler, 'descriptors'):
+            descriptors = np.zeros((len(keypoints), 128), dtype='float32')
+            descriptor_tasks = []
+            for _, _, layer_indices in groupKeypointsByLayer(keypoints):
+                for chunk_start in range(0, len(layer_indices), parallel_descriptor_chunk_size):
+                    keypoint_indices = layer_indices[chunk_start:chunk_start + parallel_descriptor_chunk_size]
+                    descriptor_tasks.append((keypoint_indices, executor.submit(
+                        _generateDescriptorsInSharedLayer, scale_space_description, keypoints[keypoint_indices])))
+            for keypoint_indices, task in descriptor_tasks:
+                descriptors[keypoint_indices] = task.result()
+        if profiler is not None:
+            profiler.count('duplicates', keypoints=len(keypoints))
+            profiler.count('descriptors', keypoints=len(keypoints))
+    except BrokenProcessPool:
+        # a worker died; the next call starts a new pool
+        if _worker_pools.get(num_workers) is executor:
+            del _worker_pools[num_workers]
+        raise
     return keypoints, descriptors
 
 
-def generateBaseImage(image, sigma, assumed_blur):
-    """Generate base image from input image by upsampling by 2 in both directions and blurring
+def getWorkerPool(num_workers):
+    """Return the process pool of num_workers workers used by the parallel mode, started on first use and kept for later calls
+    """
+    if num_workers not in _worker_pools:
+        _worker_pools[num_workers] = ProcessPoolExecutor(max_workers=num_workers)
+    return _worker_pools[num_workers]
+
+
+def allocateImages(shape):
+    """Allocate an uninitialized float32 array of one pyramid octave
+    """
+    return np.empty(shape, dtype='float32')
+
+
+# shared memory block names of the arrays created by allocateSharedImages, by array id (removed when the array is collected)
+_shared_image_blocks = {}
+
+
+def allocateSharedImages(shape):
+    """Allocate an uninitialized float32 array in a new shared memory block, which is unlinked once the array is garbage collected.
+    Pyramids built with it (see generateScaleSpace) are passed to worker processes without copying
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)), 1) * np.dtype('float32').itemsize)
+    images = np.ndarray(shape, dtype='float32', buffer=block.buf)
+    _shared_image_blocks[id(images)] = block.name
+    weakref.finalize(images, releaseSharedBlock, block, id(images))
+    return images
+
+
+def releaseSharedBlock(block, array_id):
+    _shared_image_blocks.pop(array_id, None)
+    block.unlink()
+    # at interpreter exit the array may still exist; its memory is freed with the process
+    with suppress(BufferError):
+        block.close()
+
+
+def shareScaleSpace(gaussian_images, dog_images):
+    """Place the Gaussian and DoG images of each octave in shared memory: octaves allocated by allocateSharedImages are used as they are,
+    others are copied into new shared arrays. Return those copies (to be kept alive while workers use them) and a picklable description
+    of the shared arrays for attachSharedScaleSpace
+    """
+    shared_copies = []
+    scale_space_description = []
+    for octave_images in zip(gaussian_images, dog_images):
+        octave_description = []
+        for images in octave_images:
+            if id(images) not in _shared_image_blocks:
+                shared_images = allocateSharedImages(images.shape)
+                shared_images[:] = images
+                shared_copies.append(shared_images)
+                images = shared_images
+            octave_description.append((_shared_image_blocks[id(images)], images.shape))
+        scale_space_description.append(tuple(octave_description))
+    return shared_copies, tuple(scale_space_description)
+
+
+# pyramids attached by this worker process, kept until a different scale space is requested
+_attached_scale_space = {}
+
+
+def attachSharedScaleSpace(scale_space_description):
+    """Attach (in a worker process) to the pyramids described by shareScaleSpace.
+    Return the Gaussian and DoG images as one (num_images, rows, cols) array per octave and the worker's gradient map cache for them
+    """
+    if _attached_scale_space.get('description') != scale_space_description:
+        previous_blocks = _attached_scale_space.get('blocks', [])
+        _attached_scale_space.clear()
+        for block in previous_blocks:
+            block.close()
+        blocks = []
+        pyramids = ([], [])
+        for octave_description in scale_space_description:
+            for pyramid, (name, shape) in zip(pyramids, octave_description):
+                # workers share the parent's resource tracker, so the blocks are unlinked once, by the parent
+                block = shared_memory.SharedMemory(name=name)
+                blocks.append(block)
+                pyramid.append(np.ndarray(shape, dtype='float32', buffer=block.buf))
+        _attached_scale_space.update(description=scale_space_description, blocks=blocks,
+                                     gaussian_images=pyramids[0], dog_images=pyramids[1], gradient_maps={})
+    return _attached_scale_space['gaussian_images'], _attached_scale_space['dog_images'], _attached_scale_space['gradient_maps']
+
+
+def _localizeScaleSpaceExtremaInSharedLayer(scale_space_description, layer, num_intervals, sigma, image_border_width):
+    _, dog_images, _ = attachSharedScaleSpace(scale_space_description)
+    return localizeScaleSpaceExtrema(dog_images, num_intervals, sigma, image_border_width, layers=[layer])
+
+
+def _computeOrientationsInSharedLayer(scale_space_description, layer, keypoints):
+    gaussian_images, _, gradient_maps = attachSharedScaleSpace(scale_space_description)
+    return computeOrientationsForKeypoints(keypoints, layer[0], gaussian_images[layer[0]][layer[1]],
+                                           gradient_maps=getGradientMaps(gradient_maps, gaussian_images, *layer))
+
+
+def _generateDescriptorsInSharedLayer(scale_space_description, keypoints):
+    gaussian_images, _, gradient_maps = attachSharedScaleSpace(scale_space_description)
+    return generateDescriptors(keypoints, gaussian_images, gradient_maps=gradient_maps)
+
+
+def generateBaseImage(image, sigma, assumed_blur, dst=None):
+    """Generate base image from input image by upsampling by 2 in both directions and blurring, optionally into a preallocated dst
     """
     image = cv2.resize(image, (0, 0), fx=2, fy=2, interpolation=cv2.INTER_LINEAR)
     sigma_diff = np.sqrt(max((sigma ** 2) - ((2 * assumed_blur) ** 2), 0.01))
     # the image blur is now sigma instead of assumed_blur
-    return cv2.GaussianBlur(image, (0, 0), sigmaX=sigma_diff, sigmaY=sigma_diff)
+    return cv2.GaussianBlur(image, (0, 0), dst=dst, sigmaX=sigma_diff, sigmaY=sigma_diff)
 
 
 def computeNumberOfOctaves(image_shape):
@@ -38,8 +762,10 @@ def computeNumberOfOctaves(image_shape):
     return int(round(np.log(min(image_shape)) / np.log(2) - 1))
 
 
+@lru_cache(maxsize=None)
 def generateGaussianKernels(sigma, num_intervals):
     """Generate list of gaussian kernels at which to blur the input image. Default values of sigma, intervals, and octaves follow section 3 of Lowe's paper.
+    The list is cached per (sigma, num_intervals) and returned read-only
     """
     num_images_per_octave = num_intervals + 3
     k = 2 ** (1. / num_intervals)
@@ -52,238 +778,454 @@ def generateGaussianKernels(sigma, num_intervals):
         sigma_total = k * sigma_previous
         gaussian_kernels[image_index] = np.sqrt(
             sigma_total ** 2 - sigma_previous ** 2)
+    gaussian_kernels.flags.writeable = False
     return gaussian_kernels
 
 
-def generateGaussianImages(image, num_octaves, gaussian_kernels):
-    """Generate scale-space pyramid of Gaussian images
+@lru_cache(maxsize=None)
+def generateSeparableGaussianKernels(sigma, num_intervals):
+    """Generate the 1D float32 kernels that take each Gaussian image of an octave to the next one, cached per (sigma, num_intervals).
+    Kernel sizes follow cv2.GaussianBlur for float images, so filtering with cv2.sepFilter2D gives the same images
+    """
+    separable_kernels = []
+    for gaussian_kernel in generateGaussianKernels(sigma, num_intervals)[1:]:
+        kernel = cv2.getGaussianKernel(int(np.round(gaussian_kernel * 4 * 2 + 1)) | 1, gaussian_kernel, cv2.CV_32F)
+        kernel.flags.writeable = False
+        separable_kernels.append(kernel)
+    return tuple(separable_kernels)
+
+
+def generateGaussianImages(image, num_octaves, separable_kernels, allocate=None):
+    """Generate scale-space pyramid of Gaussian images as one preallocated (num_images_per_octave, rows, cols) float32 array per octave.
+    image is the base image, or a buffer of the first octave's shape that already holds it in its first slice.
+    allocate(shape) optionally creates the arrays of the other octaves, np.empty by default
     """
+    allocate = allocate or allocateImages
     gaussian_images = []
+    if image.ndim == 3:
+        gaussian_images_in_octave = image
+    else:
+        gaussian_images_in_octave = allocate((len(separable_kernels) + 1,) + image.shape)
+        # first image in octave already has the correct blur
+        gaussian_images_in_octave[0] = image
 
     for octave_index in range(num_octaves):
-        gaussian_images_in_octave = []
-        # first image in octave already has the correct blur
-        gaussian_images_in_octave.append(image)
-        for gaussian_kernel in gaussian_kernels[1:]:
-            image = cv2.GaussianBlur(
-                image, (0, 0), sigmaX=gaussian_kernel, sigmaY=gaussian_kernel)
-            gaussian_images_in_octave.append(image)
+        for image_index, kernel in enumerate(separable_kernels, start=1):
+            cv2.sepFilter2D(gaussian_images_in_octave[image_index - 1], -1, kernel, kernel,
+                            dst=gaussian_images_in_octave[image_index])
         gaussian_images.append(gaussian_images_in_octave)
+        if octave_index == num_octaves - 1:
+            break
         octave_base = gaussian_images_in_octave[-3]
-        image = cv2.resize(octave_base, (int(
-            octave_base.shape[1] / 2), int(octave_base.shape[0] / 2)), interpolation=cv2.INTER_NEAREST)
-    return np.array(gaussian_images, dtype=object)
+        num_rows, num_cols = int(octave_base.shape[0] / 2), int(octave_base.shape[1] / 2)
+        gaussian_images_in_octave = allocate((len(separable_kernels) + 1, num_rows, num_cols))
+        cv2.resize(octave_base, (num_cols, num_rows), dst=gaussian_images_in_octave[0], interpolation=cv2.INTER_NEAREST)
+    return gaussian_images
 
 
-def generateDoGImages(gaussian_images):
-    """Generate Difference-of-Gaussians image pyramid
+def generateDoGImages(gaussian_images, allocate=None):
+    """Generate Difference-of-Gaussians image pyramid, subtracting each octave's Gaussian images into one preallocated stack
+    (created by allocate(shape) if given, np.empty otherwise)
     """
+    allocate = allocate or allocateImages
     dog_images = []
 
     for gaussian_images_in_octave in gaussian_images:
-        dog_images_in_octave = []
-        for first_image, second_image in zip(gaussian_images_in_octave, gaussian_images_in_octave[1:]):
-            # ordinary cv2.subtraction will not work because the images are unsigned integers
-            dog_images_in_octave.append(cv2.subtract(second_image, first_image))
+        dog_images_in_octave = allocate((len(gaussian_images_in_octave) - 1,) + gaussian_images_in_octave.shape[1:])
+        np.subtract(gaussian_images_in_octave[1:], gaussian_images_in_octave[:-1], out=dog_images_in_octave)
         dog_images.append(dog_images_in_octave)
-    return np.array(dog_images, dtype=object)
+    return dog_images
 
 
-def findScaleSpaceExtrema(gaussian_images, dog_images, num_intervals, sigma, image_border_width, contrast_threshold=0.04):
-    """Find pixel positions of np.all scale-space extrema in the image pyramid
+def findScaleSpaceExtrema(gaussian_images, dog_images, num_intervals, sigma, image_border_width, contrast_threshold=0.04, gradient_maps=None, layers=None, max_keypoints=None, min_response=None, spread_grid_size=None, profiler=None):
+    """Find pixel positions of np.all scale-space extrema in the image pyramid.
+    layers optionally restricts the search to candidates found in the given (octave_index, image_index) DoG layers.
+    max_keypoints, min_response and spread_grid_size select the localized extrema that get orientations (see selectKeypoints)
+    """
+    localized_keypoints = localizeScaleSpaceExtrema(dog_images, num_intervals, sigma, image_border_width, contrast_threshold, layers, profiler)
+    with profileStage(profiler, 'selection'):
+        localized_keypoints = selectKeypoints(localized_keypoints, dog_images[0][0].shape, max_keypoints, min_response, spread_grid_size)
+    with profileStage(profiler, 'orientation'):
+        keypoints = assignOrientations(localized_keypoints, gaussian_images, gradient_maps)
+    if profiler is not None:
+        profiler.count('selection', keypoints=len(localized_keypoints))
+        profiler.count('orientation', keypoints=len(keypoints))
+    return keypoints
+
+
+def localizeScaleSpaceExtrema(dog_images, num_intervals, sigma, image_border_width, contrast_threshold=0.04, layers=None, profiler=None):
+    """Find the candidate extrema of the given (octave_index, image_index) DoG layers (all layers by default) and localize them.
+    Return a KeypointTable without orientations in candidate order
     """
     # from OpenCV implementation
     threshold = np.floor(0.5 * contrast_threshold / num_intervals * 255)
-    keypoints = []
+    if layers is None:
+        layers = [(octave_index, image_index) for octave_index, dog_images_in_octave in enumerate(dog_images)
+                  for image_index in range(1, len(dog_images_in_octave) - 1)]
 
-    for octave_index, dog_images_in_octave in enumerate(dog_images):
-        for image_index, (first_image, second_image, third_image) in enumerate(zip(dog_images_in_octave, dog_images_in_octave[1:], dog_images_in_octave[2:])):
-            # (i, j) is the center of the 3x3 array
-            for i in range(image_border_width, first_image.shape[0] - image_border_width):
-                for j in range(image_border_width, first_image.shape[1] - image_border_width):
-                    if isPixelAnExtremum(first_image[i-1:i+2, j-1:j+2], second_image[i-1:i+2, j-1:j+2], third_image[i-1:i+2, j-1:j+2], threshold):
-                        localization_result = localizeExtremumViaQuadraticFit(
-                            i, j, image_index + 1, octave_index, num_intervals, dog_images_in_octave, sigma, contrast_threshold, image_border_width)
-                        if localization_result is not None:
-                            keypoint, localized_image_index = localization_result
-                            keypoints_with_orientations = computeKeypointsWithOrientations(
-                                keypoint, octave_index, gaussian_images[octave_index][localized_image_index])
-                            for keypoint_with_orientation in keypoints_with_orientations:
-                                keypoints.append(keypoint_with_orientation)
-    return keypoints
+    candidates = []
+    with profileStage(profiler, 'extrema'):
+        for octave_index, image_index in layers:
+            dog_images_in_octave = dog_images[octave_index]
+            # candidate extrema of the whole layer at once, in the same row-major order as a pixel-by-pixel scan
+            rows, cols = findPixelExtremaInLayer(
+                dog_images_in_octave[image_index - 1], dog_images_in_octave[image_index], dog_images_in_octave[image_index + 1], threshold, image_border_width)
+            candidates.append(np.stack([np.full(len(rows), octave_index), np.full(
+                len(rows), image_index), rows, cols], axis=1))
+        candidates = np.concatenate(candidates) if candidates else np.zeros((0, 4), dtype=int)
 
+    with profileStage(profiler, 'localization'):
+        localized_keypoints = localizeExtremaViaQuadraticFit(
+            candidates, dog_images, num_intervals, sigma, contrast_threshold, image_border_width)
+    if profiler is not None:
+        profiler.count('extrema', layers=len(layers), candidates=len(candidates))
+        profiler.count('localization', keypoints=len(localized_keypoints))
+    return localized_keypoints
 
-def isPixelAnExtremum(first_subimage, second_subimage, third_subimage, threshold):
-    """Return True if the center element of the 3x3x3 input array is strictly greater than or less than np.all its neighbors, False otherwise
-    """
-    center_pixel_value = second_subimage[1, 1]
-    if abs(center_pixel_value) > threshold:
-        if center_pixel_value > 0:
-            return np.all(center_pixel_value >= first_subimage) and \
-                np.all(center_pixel_value >= third_subimage) and \
-                np.all(center_pixel_value >= second_subimage[0, :]) and \
-                np.all(center_pixel_value >= second_subimage[2, :]) and \
-                center_pixel_value >= second_subimage[1, 0] and \
-                center_pixel_value >= second_subimage[1, 2]
-        elif center_pixel_value < 0:
-            return np.all(center_pixel_value <= first_subimage) and \
-                np.all(center_pixel_value <= third_subimage) and \
-                np.all(center_pixel_value <= second_subimage[0, :]) and \
-                np.all(center_pixel_value <= second_subimage[2, :]) and \
-                center_pixel_value <= second_subimage[1, 0] and \
-                center_pixel_value <= second_subimage[1, 2]
-    return False
-
-
-def localizeExtremumViaQuadraticFit(i, j, image_index, octave_index, num_intervals, dog_images_in_octave, sigma, contrast_threshold, image_border_width, eigenvalue_ratio=10, num_attempts_until_convergence=5):
-    """Iteratively refine pixel positions of scale-space extrema via quadratic fit around each extremum's neighbors
-    """
-    extremum_is_outside_image = False
-    image_shape = dog_images_in_octave[0].shape
-    for attempt_index in range(num_attempts_until_convergence):
-        # need to convert from uint8 to np.float32 to compute derivatives and need to rescale pixel values to [0, 1] to apply Lowe's thresholds
-        first_image, second_image, third_image = dog_images_in_octave[image_index-1:image_index+2]
-        pixel_cube = np.stack([first_image[i-1:i+2, j-1:j+2],
-                            second_image[i-1:i+2, j-1:j+2],
-                            third_image[i-1:i+2, j-1:j+2]]).astype('float32') / 255.
-        gradient = computeGradientAtCenterPixel(pixel_cube)
-        hessian = computeHessianAtCenterPixel(pixel_cube)
-        extremum_update = -np.linalg.lstsq(hessian, gradient, rcond=None)[0]
-        if abs(extremum_update[0]) < 0.5 and abs(extremum_update[1]) < 0.5 and abs(extremum_update[2]) < 0.5:
-            break
-        j += int(round(extremum_update[0]))
-        i += int(round(extremum_update[1]))
-        image_index += int(round(extremum_update[2]))
-        # make sure the new pixel_cube will lie entirely within the image
-        if i < image_border_width or i >= image_shape[0] - image_border_width or j < image_border_width or j >= image_shape[1] - image_border_width or image_index < 1 or image_index > num_intervals:
-            extremum_is_outside_image = True
-            break
-    if extremum_is_outside_image or attempt_index >= num_attempts_until_convergence - 1:
-        return None
-
-    functionValueAtUpdatedExtremum = pixel_cube[1,
-                                                1, 1] + 0.5 * np.dot(gradient, extremum_update)
-    if abs(functionValueAtUpdatedExtremum) * num_intervals >= contrast_threshold:
-        xy_hessian = hessian[:2, :2]
-        xy_hessian_trace = np.trace(xy_hessian)
-        xy_hessian_det = np.linalg.det(xy_hessian)
-        if xy_hessian_det > 0 and eigenvalue_ratio * (xy_hessian_trace ** 2) < ((eigenvalue_ratio + 1) ** 2) * xy_hessian_det:
-            # Contrast check passed -- construct and return OpenCV KeyPoint object
-            keypoint = cv2.KeyPoint()
-            keypoint.pt = ((j + extremum_update[0]) * (2 ** octave_index),
-                           (i + extremum_update[1]) * (2 ** octave_index))
-            keypoint.octave = octave_index + image_index * \
-                (2 ** 8) + \
-                int(round((extremum_update[2] + 0.5) * 255)) * (2 ** 16)
-            keypoint.size = sigma * (2 ** ((image_index + extremum_update[2]) / np.float32(num_intervals))) * (
-                2 ** (octave_index + 1))  # octave_index + 1 because the input image was doubled
-            keypoint.response = abs(functionValueAtUpdatedExtremum)
-            return keypoint, image_index
-    return None
-
-
-def computeGradientAtCenterPixel(pixel_array):
-    """Approximate gradient at center pixel [1, 1, 1] of 3x3x3 array using central difference formula of order O(h^2), where h is the step size
-    """
-    dx = 0.5 * (pixel_array[1, 1, 2] - pixel_array[1, 1, 0])
-    dy = 0.5 * (pixel_array[1, 2, 1] - pixel_array[1, 0, 1])
-    ds = 0.5 * (pixel_array[2, 1, 1] - pixel_array[0, 1, 1])
-    return np.array([dx, dy, ds])
-
-
-def computeHessianAtCenterPixel(pixel_array):
-    """Approximate Hessian at center pixel [1, 1, 1] of 3x3x3 array using central difference formula of order O(h^2), where h is the step size
-    """
-    center_pixel_value = pixel_array[1, 1, 1]
-    dxx = pixel_array[1, 1, 2] - 2 * center_pixel_value + pixel_array[1, 1, 0]
-    dyy = pixel_array[1, 2, 1] - 2 * center_pixel_value + pixel_array[1, 0, 1]
-    dss = pixel_array[2, 1, 1] - 2 * center_pixel_value + pixel_array[0, 1, 1]
-    dxy = 0.25 * (pixel_array[1, 2, 2] - pixel_array[1,
-                  2, 0] - pixel_array[1, 0, 2] + pixel_array[1, 0, 0])
-    dxs = 0.25 * (pixel_array[2, 1, 2] - pixel_array[2,
-                  1, 0] - pixel_array[0, 1, 2] + pixel_array[0, 1, 0])
-    dys = 0.25 * (pixel_array[2, 2, 1] - pixel_array[2,
-                  0, 1] - pixel_array[0, 2, 1] + pixel_array[0, 0, 1])
-    return np.array([[dxx, dxy, dxs],
-                  [dxy, dyy, dys],
-                  [dxs, dys, dss]])
-
-
-
-def computeKeypointsWithOrientations(keypoint, octave_index, gaussian_image, radius_factor=3, num_bins=36, peak_ratio=0.8, scale_factor=1.5):
-    """Compute orientations for each keypoint
+
+def assignOrientations(localized_keypoints, gaussian_images, gradient_maps=None):
+    """Assign orientations to localized keypoints. Keypoints with several orientation peaks are repeated, in the order of the input keypoints
     """
+    if gradient_maps is None:
+        gradient_maps = {}
+    # orientations are assigned for all keypoints of the same Gaussian image at once, then put back in input order
     keypoints_with_orientations = []
-    image_shape = gaussian_image.shape
-
-    # compare with keypoint.size computation in localizeExtremumViaQuadraticFit()
-    scale = scale_factor * keypoint.size / np.float32(2 ** (octave_index + 1))
-    radius = int(round(radius_factor * scale))
-    weight_factor = -0.5 / (scale ** 2)
-    raw_histogram = np.zeros(num_bins)
-    smooth_histogram = np.zeros(num_bins)
-
-    for i in range(-radius, radius + 1):
-        region_y = int(round(keypoint.pt[1] / np.float32(2 ** octave_index))) + i
-        if region_y > 0 and region_y < image_shape[0] - 1:
-            for j in range(-radius, radius + 1):
-                region_x = int(
-                    round(keypoint.pt[0] / np.float32(2 ** octave_index))) + j
-                if region_x > 0 and region_x < image_shape[1] - 1:
-                    dx = gaussian_image[region_y, region_x + 1] - \
-                        gaussian_image[region_y, region_x - 1]
-                    dy = gaussian_image[region_y - 1, region_x] - \
-                        gaussian_image[region_y + 1, region_x]
-                    gradient_magnitude = np.sqrt(dx * dx + dy * dy)
-                    gradient_orientation = np.rad2deg(np.arctan2(dy, dx))
-                    # constant in front of exponential can be dropped because we will find peaks later
-                    weight = np.exp(weight_factor * (i ** 2 + j ** 2))
-                    histogram_index = int(
-                        round(gradient_orientation * num_bins / 360.))
-                    raw_histogram[histogram_index %
-                                  num_bins] += weight * gradient_magnitude
-
-    for n in range(num_bins):
-        smooth_histogram[n] = (6 * raw_histogram[n] + 4 * (raw_histogram[n - 1] + raw_histogram[(
-            n + 1) % num_bins]) + raw_histogram[n - 2] + raw_histogram[(n + 2) % num_bins]) / 16.
-    orientation_max = max(smooth_histogram)
-    orientation_peaks = np.where(np.logical_and(smooth_histogram > np.roll(
-        smooth_histogram, 1), smooth_histogram > np.roll(smooth_histogram, -1)))[0]
-    for peak_index in orientation_peaks:
-        peak_value = smooth_histogram[peak_index]
-        if peak_value >= peak_ratio * orientation_max:
-            # Quadratic peak interpolation
-            # The interpolation update is given by equation (6.30) in https://ccrma.stanford.edu/~jos/sasp/Quadratic_Interpolation_Spectral_Peaks.html
-            left_value = smooth_histogram[(peak_index - 1) % num_bins]
-            right_value = smooth_histogram[(peak_index + 1) % num_bins]
-            interpolated_peak_index = (peak_index + 0.5 * (left_value - right_value) / (
-                left_value - 2 * peak_value + right_value)) % num_bins
-            orientation = 360. - interpolated_peak_index * 360. / num_bins
-            if abs(orientation - 360.) < float_tolerance:
-                orientation = 0
-            new_keypoint = cv2.KeyPoint(
-                *keypoint.pt, keypoint.size, orientation, keypoint.response, keypoint.octave)
-            keypoints_with_orientations.append(new_keypoint)
-    return keypoints_with_orientations
-
-
-
-def compareKeypoints(keypoint1, keypoint2):
-    """Return True if keypoint1 is less than keypoint2
-    """
-    if keypoint1.pt[0] != keypoint2.pt[0]:
-        return keypoint1.pt[0] - keypoint2.pt[0]
-    if keypoint1.pt[1] != keypoint2.pt[1]:
-        return keypoint1.pt[1] - keypoint2.pt[1]
-    if keypoint1.size != keypoint2.size:
-        return keypoint2.size - keypoint1.size
-    if keypoint1.angle != keypoint2.angle:
-        return keypoint1.angle - keypoint2.angle
-    if keypoint1.response != keypoint2.response:
-        return keypoint2.response - keypoint1.response
-    if keypoint1.octave != keypoint2.octave:
-        return keypoint2.octave - keypoint1.octave
-    return keypoint2.class_id - keypoint1.class_id
+    source_indices = []
+    for octave_index, localized_image_index, keypoint_indices in groupKeypointsByLayer(localized_keypoints):
+        oriented_keypoints, oriented_sources = computeOrientationsForKeypoints(
+            localized_keypoints[keypoint_indices], octave_index, gaussian_images[octave_index][localized_image_index],
+            gradient_maps=getGradientMaps(gradient_maps, gaussian_images, octave_index, localized_image_index))
+        keypoints_with_orientations.append(oriented_keypoints)
+        source_indices.append(keypoint_indices[oriented_sources])
+    return mergeOrientedKeypoints(keypoints_with_orientations, source_indices)
+
+
+def groupKeypointsByLayer(keypoints):
+    """Yield (octave, layer, keypoint_indices) for each distinct (octave, layer) of a KeypointTable, in increasing order
+    """
+    for octave, layer in np.unique(np.stack([keypoints.octave, keypoints.layer], axis=1), axis=0).tolist():
+        yield octave, layer, np.nonzero((keypoints.octave == octave) & (keypoints.layer == layer))[0]
+
+
+def mergeOrientedKeypoints(keypoints_with_orientations, source_indices):
+    """Concatenate per-layer results of computeOrientationsForKeypoints back into the order of the keypoints they come from
+    """
+    if not keypoints_with_orientations:
+        return KeypointTable()
+    keypoints = KeypointTable.concatenate(keypoints_with_orientations)
+    return keypoints[np.argsort(np.concatenate(source_indices), kind='stable')]
+
+
+def selectKeypoints(keypoints, image_shape, max_keypoints=None, min_response=None, spread_grid_size=None):
+    """Keep the keypoints whose response is at least min_response and, of those, the max_keypoints with the highest responses.
+    With spread_grid_size, the image is split into a spread_grid_size x spread_grid_size grid and keypoints are taken
+    round-robin over its cells, strongest first within each cell, so that the budget is not spent on one textured region.
+    Selected keypoints keep their order; ties in response are broken by that order
+    """
+    if min_response is not None:
+        keypoints = keypoints[keypoints.response >= min_response]
+    if max_keypoints is None or len(keypoints) <= max_keypoints:
+        return keypoints
+
+    order = np.argsort(-keypoints.response, kind='stable')
+    if spread_grid_size is not None:
+        cell_rows = np.clip((keypoints.y * (spread_grid_size / image_shape[0])).astype(int), 0, spread_grid_size - 1)
+        cell_cols = np.clip((keypoints.x * (spread_grid_size / image_shape[1])).astype(int), 0, spread_grid_size - 1)
+        cells = (cell_rows * spread_grid_size + cell_cols)[order]
+        # rank of each keypoint within its cell, by decreasing response
+        cell_order = np.argsort(cells, kind='stable')
+        sorted_cells = cells[cell_order]
+        ranks = np.empty(len(order), dtype=int)
+        ranks[cell_order] = np.arange(len(order)) - np.searchsorted(sorted_cells, sorted_cells)
+        order = order[np.argsort(ranks, kind='stable')]
+    is_selected = np.zeros(len(keypoints), dtype=bool)
+    is_selected[order[:max_keypoints]] = True
+    return keypoints[is_selected]
+
+
+def findPixelExtremaInLayer(first_image, second_image, third_image, threshold, image_border_width):
+    """Return row and column indices of all pixels of the middle DoG image that are scale-space extrema, computed for the whole layer at once.
+    A pixel is an extremum when its absolute value exceeds threshold and it is >= (maxima) or <= (minima) all its 26 neighbors
+    """
+    # 3x3 neighborhood maximum / minimum of each DoG image; the center pixel is part of its own neighborhood
+    neighborhood_kernel = np.ones((3, 3), dtype=np.uint8)
+    neighborhood_max = np.maximum(np.maximum(cv2.dilate(first_image, neighborhood_kernel), cv2.dilate(
+        second_image, neighborhood_kernel)), cv2.dilate(third_image, neighborhood_kernel))
+    neighborhood_min = np.minimum(np.minimum(cv2.erode(first_image, neighborhood_kernel), cv2.erode(
+        second_image, neighborhood_kernel)), cv2.erode(third_image, neighborhood_kernel))
+
+    interior = (slice(image_border_width, second_image.shape[0] - image_border_width),
+                slice(image_border_width, second_image.shape[1] - image_border_width))
+    center_pixel_values = second_image[interior]
+    is_maximum = (center_pixel_values > 0) & (center_pixel_values >= neighborhood_max[interior])
+    is_minimum = (center_pixel_values < 0) & (center_pixel_values <= neighborhood_min[interior])
+    is_extremum = (np.abs(center_pixel_values) > threshold) & (is_maximum | is_minimum)
+    rows, cols = np.nonzero(is_extremum)
+    return rows + image_border_width, cols + image_border_width
+
+
+def localizeExtremaViaQuadraticFit(candidates, dog_images, num_intervals, sigma, contrast_threshold, image_border_width, eigenvalue_ratio=10, num_attempts_until_convergence=5):
+    """Iteratively refine the positions of an (N, 4) array of candidate (octave_index, image_index, i, j) scale-space extrema via a quadratic fit
+    around each extremum's neighbors.
+    Candidates whose quadratic fit moves them to a neighboring pixel keep iterating in a shrinking active set.
+    Return a KeypointTable of the localized keypoints (layer is the image index after localization) in candidate order
+    """
+    candidates = np.asarray(candidates, dtype=int).reshape(-1, 4)
+    cube_offsets = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij'), axis=-1).reshape(-1, 3)
+    keypoint_order = []
+    keypoints = []
+
+    for octave_index in np.unique(candidates[:, 0]).tolist():
+        candidate_indices = np.nonzero(candidates[:, 0] == octave_index)[0]
+        dog_stack = dog_images[octave_index]
+        if not (isinstance(dog_stack, np.ndarray) and dog_stack.ndim == 3):
+            dog_stack = np.stack(dog_stack)
+        _, num_rows, num_cols = dog_stack.shape
+        flat_offsets = (cube_offsets[:, 0] * num_rows + cube_offsets[:, 1]) * num_cols + cube_offsets[:, 2]
+        image_index, i, j = candidates[candidate_indices, 1:].T.copy()
+        active = np.arange(len(candidate_indices))
+
+        for attempt_index in range(num_attempts_until_convergence):
+            # rescale pixel values to [0, 1] to apply Lowe's thresholds
+            flat_index = (image_index[active] * num_rows + i[active]) * num_cols + j[active]
+            pixel_cubes = dog_stack.ravel()[flat_index[:, np.newaxis] + flat_offsets].reshape(-1, 3, 3, 3) / 255.
+            gradients = computeGradientsAtCenterPixels(pixel_cubes)
+            hessians = computeHessiansAtCenterPixels(pixel_cubes)
+            extremum_updates = -solveLinearSystems(hessians, gradients)
+            has_converged = np.all(np.abs(extremum_updates) < 0.5, axis=1)
+            if attempt_index < num_attempts_until_convergence - 1:
+                # candidates converging on the last attempt are rejected
+                converged = active[has_converged]
+                converged_keypoints, is_accepted = createKeypointsFromExtrema(
+                    pixel_cubes[has_converged, 1, 1, 1], gradients[has_converged], hessians[has_converged], extremum_updates[has_converged],
+                    i[converged], j[converged], image_index[converged], octave_index, num_intervals, sigma, contrast_threshold, eigenvalue_ratio)
+                keypoints.append(converged_keypoints)
+                keypoint_order.append(candidate_indices[converged[is_accepted]])
+
+            active = active[~has_converged]
+            rounded_updates = np.round(extremum_updates[~has_converged]).astype(int)
+            j[active] += rounded_updates[:, 0]
+            i[active] += rounded_updates[:, 1]
+            image_index[active] += rounded_updates[:, 2]
+            # make sure the new pixel cubes will lie entirely within the image
+            is_inside_image = (i[active] >= image_border_width) & (i[active] < num_rows - image_border_width) & \
+                (j[active] >= image_border_width) & (j[active] < num_cols - image_border_width) & \
+                (image_index[active] >= 1) & (image_index[active] <= num_intervals)
+            active = active[is_inside_image]
+            if len(active) == 0:
+                break
+
+    if not keypoints:
+        return KeypointTable()
+    keypoints = KeypointTable.concatenate(keypoints)
+    return keypoints[np.argsort(np.concatenate(keypoint_order), kind='stable')]
+
+
+def createKeypointsFromExtrema(center_pixel_values, gradients, hessians, extremum_updates, i, j, image_index, octave_index, num_intervals, sigma, contrast_threshold, eigenvalue_ratio):
+    """Apply Lowe's contrast and edge-response checks to converged extrema.
+    Return a KeypointTable of the accepted extrema and the mask of accepted extrema
+    """
+    function_values = center_pixel_values.astype('float64') + 0.5 * np.einsum('ij,ij->i', gradients, extremum_updates)
+    xy_hessians = hessians[:, :2, :2]
+    xy_hessian_traces = xy_hessians[:, 0, 0] + xy_hessians[:, 1, 1]
+    xy_hessian_dets = np.linalg.det(xy_hessians)
+    is_accepted = (np.abs(function_values) * num_intervals >= contrast_threshold) & (xy_hessian_dets > 0) & \
+        (eigenvalue_ratio * (xy_hessian_traces ** 2) < ((eigenvalue_ratio + 1) ** 2) * xy_hessian_dets)
+
+    extremum_updates, function_values = extremum_updates[is_accepted], function_values[is_accepted]
+    i, j, image_index = i[is_accepted], j[is_accepted], image_index[is_accepted]
+    keypoints = KeypointTable(
+        x=(j + extremum_updates[:, 0]) * (2 ** octave_index),
+        y=(i + extremum_updates[:, 1]) * (2 ** octave_index),
+        size=sigma * (2 ** ((image_index + extremum_updates[:, 2]) / np.float32(num_intervals))) * (
+            2 ** (octave_index + 1)),  # octave_index + 1 because the input image was doubled
+        angle=np.full(len(image_index), -1),
+        response=np.abs(function_values),
+        octave=np.full(len(image_index), octave_index),
+        layer=image_index,
+        layer_offset=np.round((extremum_updates[:, 2] + 0.5) * 255).astype(int))
+    return keypoints, is_accepted
+
+
+def solveLinearSystems(matrices, vectors):
+    """Solve a stack of 3x3 linear systems, falling back to least squares for singular matrices
+    """
+    try:
+        return np.linalg.solve(matrices, vectors[..., np.newaxis])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.array([np.linalg.lstsq(matrix, vector, rcond=None)[0] for matrix, vector in zip(matrices, vectors)]).reshape(vectors.shape)
+
+
+def computeGradientsAtCenterPixels(pixel_arrays):
+    """Approximate the gradients at the center pixels [1, 1, 1] of an (N, 3, 3, 3) stack of pixel arrays using central difference formula of order O(h^2),
+    where h is the step size
+    """
+    dx = 0.5 * (pixel_arrays[:, 1, 1, 2] - pixel_arrays[:, 1, 1, 0]).astype('float64')
+    dy = 0.5 * (pixel_arrays[:, 1, 2, 1] - pixel_arrays[:, 1, 0, 1]).astype('float64')
+    ds = 0.5 * (pixel_arrays[:, 2, 1, 1] - pixel_arrays[:, 0, 1, 1]).astype('float64')
+    return np.stack([dx, dy, ds], axis=1)
+
+
+def computeHessiansAtCenterPixels(pixel_arrays):
+    """Approximate the Hessians at the center pixels [1, 1, 1] of an (N, 3, 3, 3) stack of pixel arrays using central difference formula of order O(h^2),
+    where h is the step size
+    """
+    # second derivatives in float64, mixed derivatives from float32 differences, which keeps keypoints identical to the original per-pixel fit
+    pixel_arrays_64 = pixel_arrays.astype('float64')
+    center_pixel_values = pixel_arrays_64[:, 1, 1, 1]
+    dxx = pixel_arrays_64[:, 1, 1, 2] - 2 * center_pixel_values + pixel_arrays_64[:, 1, 1, 0]
+    dyy = pixel_arrays_64[:, 1, 2, 1] - 2 * center_pixel_values + pixel_arrays_64[:, 1, 0, 1]
+    dss = pixel_arrays_64[:, 2, 1, 1] - 2 * center_pixel_values + pixel_arrays_64[:, 0, 1, 1]
+    dxy = 0.25 * (pixel_arrays[:, 1, 2, 2] - pixel_arrays[:, 1, 2, 0] -
+                  pixel_arrays[:, 1, 0, 2] + pixel_arrays[:, 1, 0, 0]).astype('float64')
+    dxs = 0.25 * (pixel_arrays[:, 2, 1, 2] - pixel_arrays[:, 2, 1, 0] -
+                  pixel_arrays[:, 0, 1, 2] + pixel_arrays[:, 0, 1, 0]).astype('float64')
+    dys = 0.25 * (pixel_arrays[:, 2, 2, 1] - pixel_arrays[:, 2, 0, 1] -
+                  pixel_arrays[:, 0, 2, 1] + pixel_arrays[:, 0, 0, 1]).astype('float64')
+    return np.stack([np.stack([dxx, dxy, dxs], axis=1),
+                     np.stack([dxy, dyy, dys], axis=1),
+                     np.stack([dxs, dys, dss], axis=1)], axis=1)
+
+
+def computeGradientMaps(gaussian_image):
+    """Compute gradient magnitude and orientation (in degrees, within [-180, 180]) of every pixel of a Gaussian image, using the same central differences as the per-pixel loops.
+    Border pixels have no valid gradient and are left at 0
+    """
+    gradient_magnitude = np.zeros(gaussian_image.shape, dtype=gaussian_image.dtype)
+    gradient_orientation = np.zeros(gaussian_image.shape, dtype=gaussian_image.dtype)
+    dx = gaussian_image[1:-1, 2:] - gaussian_image[1:-1, :-2]
+    dy = gaussian_image[:-2, 1:-1] - gaussian_image[2:, 1:-1]
+    gradient_magnitude[1:-1, 1:-1] = np.sqrt(dx * dx + dy * dy)
+    gradient_orientation[1:-1, 1:-1] = np.rad2deg(np.arctan2(dy, dx))
+    return gradient_magnitude, gradient_orientation
+
+
+def computeOrientationsForKeypoints(keypoints, octave_index, gaussian_image, gradient_maps=None, radius_factor=3, num_bins=36, peak_ratio=0.8, scale_factor=1.5):
+    """Compute orientations for a KeypointTable of keypoints of the same Gaussian image from its gradient orientation histograms.
+    Return the KeypointTable of keypoints with orientations and, for each of them, the index of the input keypoint it comes from
+    """
+    if len(keypoints) == 0:
+        return KeypointTable(), np.zeros(0, dtype=int)
+    if gradient_maps is None:
+        gradient_maps = computeGradientMaps(gaussian_image)
+    gradient_magnitude, gradient_orientation = gradient_maps
+    num_rows, num_cols = gaussian_image.shape
+
+    # compare with keypoint size computation in createKeypointsFromExtrema()
+    scales = scale_factor * keypoints.size.astype('float64') / np.float32(2 ** (octave_index + 1))
+    radii = np.round(radius_factor * scales).astype(int)
+    weight_factors = -0.5 / (scales ** 2)
+    centers_x = np.round(keypoints.x.astype('float64') / np.float32(2 ** octave_index)).astype(int)
+    centers_y = np.round(keypoints.y.astype('float64') / np.float32(2 ** octave_index)).astype(int)
+    raw_histograms = np.zeros((len(keypoints), num_bins))
+
+    # keypoints sharing a radius share the same square window of offsets
+    for radius in np.unique(radii).tolist():
+        keypoint_indices = np.nonzero(radii == radius)[0]
+        offsets_i, offsets_j = np.meshgrid(np.arange(-radius, radius + 1), np.arange(-radius, radius + 1), indexing='ij')
+        offsets_i, offsets_j = offsets_i.ravel(), offsets_j.ravel()
+        region_y = centers_y[keypoint_indices, np.newaxis] + offsets_i
+        region_x = centers_x[keypoint_indices, np.newaxis] + offsets_j
+        is_inside_image = (region_y > 0) & (region_y < num_rows - 1) & (region_x > 0) & (region_x < num_cols - 1)
+        # row-major masking keeps the accumulation order of the per-pixel loop, so the sums are identical
+        histogram_rows = np.broadcast_to(np.arange(len(keypoint_indices))[:, np.newaxis], region_y.shape)[is_inside_image]
+        region_y, region_x = region_y[is_inside_image], region_x[is_inside_image]
+        # constant in front of exponential can be dropped because we will find peaks later
+        weights = np.exp(weight_factors[keypoint_indices][histogram_rows] *
+                         np.broadcast_to(offsets_i ** 2 + offsets_j ** 2, is_inside_image.shape)[is_inside_image])
+        histogram_indices = np.round(gradient_orientation[region_y, region_x].astype('float64') * num_bins / 360.).astype(int) % num_bins
+        raw_histograms[keypoint_indices] = np.bincount(histogram_rows * num_bins + histogram_indices,
+                                                       weights=weights * gradient_magnitude[region_y, region_x],
+                                                       minlength=len(keypoint_indices) * num_bins).reshape(-1, num_bins)
+
+    smooth_histograms = (6 * raw_histograms + 4 * (np.roll(raw_histograms, 1, axis=1) + np.roll(raw_histograms, -1, axis=1)) +
+                         np.roll(raw_histograms, 2, axis=1) + np.roll(raw_histograms, -2, axis=1)) / 16.
+    orientation_max = smooth_histograms.max(axis=1, keepdims=True)
+    left_values = np.roll(smooth_histograms, 1, axis=1)
+    right_values = np.roll(smooth_histograms, -1, axis=1)
+    is_peak = (smooth_histograms > left_values) & (smooth_histograms > right_values) & \
+        (smooth_histograms >= peak_ratio * orientation_max)
+    peak_keypoints, peak_indices = np.nonzero(is_peak)
+    # Quadratic peak interpolation
+    # The interpolation update is given by equation (6.30) in https://ccrma.stanford.edu/~jos/sasp/Quadratic_Interpolation_Spectral_Peaks.html
+    peak_values = smooth_histograms[peak_keypoints, peak_indices]
+    left_values = left_values[peak_keypoints, peak_indices]
+    right_values = right_values[peak_keypoints, peak_indices]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        interpolated_peak_indices = (peak_indices + 0.5 * (left_values - right_values) / (
+            left_values - 2 * peak_values + right_values)) % num_bins
+    orientations = 360. - interpolated_peak_indices * 360. / num_bins
+    orientations[np.abs(orientations - 360.) < float_tolerance] = 0
+
+    keypoints_with_orientations = keypoints[peak_keypoints]
+    keypoints_with_orientations.angle = orientations.astype('float32')
+    return keypoints_with_orientations, peak_keypoints
+
+
+class KeypointTable:
+    """Struct-of-arrays set of keypoints: one NumPy column per keypoint attribute instead of a list of cv2.KeyPoint objects.
+    octave is the signed octave index, layer the Gaussian image index within the octave and layer_offset the sub-layer
+    offset quantized to a byte, the three fields OpenCV packs into KeyPoint.octave (see packOctaves and unpackOctaves)
+    """
+    columns = ('x', 'y', 'size', 'angle', 'response', 'octave', 'layer', 'layer_offset', 'class_id')
+
+    def __init__(self, x=(), y=(), size=(), angle=(), response=(), octave=(), layer=(), layer_offset=(), class_id=None):
+        # float columns are single precision, like the fields of cv2.KeyPoint
+        self.x = np.asarray(x, dtype='float32')
+        self.y = np.asarray(y, dtype='float32')
+        self.size = np.asarray(size, dtype='float32')
+        self.angle = np.asarray(angle, dtype='float32')
+        self.response = np.asarray(response, dtype='float32')
+        self.octave = np.asarray(octave, dtype='int32')
+        self.layer = np.asarray(layer, dtype='int32')
+        self.layer_offset = np.asarray(layer_offset, dtype='int32')
+        self.class_id = np.full(len(self.x), -1, dtype='int32') if class_id is None else np.asarray(class_id, dtype='int32')
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        """Select rows with a slice, an index array or a boolean mask
+        """
+        return KeypointTable(**{column: getattr(self, column)[index] for column in self.columns})
+
+    def copy(self):
+        return KeypointTable(**{column: getattr(self, column).copy() for column in self.columns})
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, column).nbytes for column in self.columns)
+
+    @property
+    def points(self):
+        return np.stack([self.x, self.y], axis=1)
+
+    def packedOctaves(self):
+        return packOctaves(self.octave, self.layer, self.layer_offset)
+
+    @staticmethod
+    def concatenate(tables):
+        tables = list(tables)
+        if not tables:
+            return KeypointTable()
+        return KeypointTable(**{column: np.concatenate([getattr(table, column) for table in tables]) for column in KeypointTable.columns})
+
+    @staticmethod
+    def fromKeyPoints(keypoints):
+        packed_octaves = np.array([keypoint.octave for keypoint in keypoints], dtype=int)
+        octaves, layers, _ = unpackOctaves(packed_octaves)
+        return KeypointTable(
+            x=[keypoint.pt[0] for keypoint in keypoints], y=[keypoint.pt[1] for keypoint in keypoints],
+            size=[keypoint.size for keypoint in keypoints], angle=[keypoint.angle for keypoint in keypoints],
+            response=[keypoint.response for keypoint in keypoints], octave=octaves, layer=layers,
+            layer_offset=(packed_octaves >> 16) & 255, class_id=[keypoint.class_id for keypoint in keypoints])
+
+    def toKeyPoints(self):
+        """Build OpenCV KeyPoint objects, e.g. for cv2.drawKeypoints and cv2.drawMatches
+        """
+        return [cv2.KeyPoint(x, y, size, angle, response, octave, class_id) for x, y, size, angle, response, octave, class_id in zip(
+            self.x.tolist(), self.y.tolist(), self.size.tolist(), self.angle.tolist(), self.response.tolist(),
+            self.packedOctaves().tolist(), self.class_id.tolist())]
 
 
 def removeDuplicateKeypoints(keypoints):
@@ -291,157 +1233,182 @@ def removeDuplicateKeypoints(keypoints):
     """
     if len(keypoints) < 2:
         return keypoints
+    return keypoints[findUniqueKeypoints(keypoints)]
 
-    keypoints.sort(key=cmp_to_key(compareKeypoints))
-    unique_keypoints = [keypoints[0]]
 
-    for next_keypoint in keypoints[1:]:
-        last_unique_keypoint = unique_keypoints[-1]
-        if last_unique_keypoint.pt[0] != next_keypoint.pt[0] or \
-           last_unique_keypoint.pt[1] != next_keypoint.pt[1] or \
-           last_unique_keypoint.size != next_keypoint.size or \
-           last_unique_keypoint.angle != next_keypoint.angle:
-            unique_keypoints.append(next_keypoint)
-    return unique_keypoints
+def findUniqueKeypoints(keypoints):
+    """Return the indices that removeDuplicateKeypoints keeps, in its sorted order
+    """
+    if len(keypoints) < 2:
+        return np.arange(len(keypoints))
+    # sort by x, y, decreasing size, angle, decreasing response, octave and class_id (np.lexsort takes the last key first)
+    order = np.lexsort((-keypoints.class_id, -keypoints.packedOctaves(), -keypoints.response, keypoints.angle,
+                        -keypoints.size, keypoints.y, keypoints.x))
+    keypoints = keypoints[order]
+    is_unique = np.ones(len(keypoints), dtype=bool)
+    is_unique[1:] = (keypoints.x[1:] != keypoints.x[:-1]) | (keypoints.y[1:] != keypoints.y[:-1]) | \
+                    (keypoints.size[1:] != keypoints.size[:-1]) | (keypoints.angle[1:] != keypoints.angle[:-1])
+    return order[is_unique]
 
 
 def convertKeypointsToInputImageSize(keypoints):
     """Convert keypoint point, size, and octave to input image size
     """
-    converted_keypoints = []
-    for keypoint in keypoints:
-        keypoint.pt = tuple(0.5 * np.array(keypoint.pt))
-        keypoint.size *= 0.5
-        keypoint.octave = (keypoint.octave & ~255) | (
-            (keypoint.octave - 1) & 255)
-        converted_keypoints.append(keypoint)
+    converted_keypoints = keypoints.copy()
+    converted_keypoints.x *= 0.5
+    converted_keypoints.y *= 0.5
+    converted_keypoints.size *= 0.5
+    converted_keypoints.octave -= 1
     return converted_keypoints
 
 
+def unpackOctaves(packed_octaves):
+    """Compute octaves, layers, and scales from an array of packed keypoint octaves
+    """
+    packed_octaves = np.asarray(packed_octaves, dtype=int)
+    octaves = packed_octaves & 255
+    layers = (packed_octaves >> 8) & 255
+    octaves = np.where(octaves >= 128, octaves | -128, octaves)
+    return octaves, layers, computeOctaveScales(octaves)
+
+
+def computeOctaveScales(octaves):
+    """Scale from the input image to the Gaussian images of each signed octave index
+    """
+    return np.where(octaves >= 0, 1 / 2. ** octaves, 2. ** -octaves)
+
+
+def packOctaves(octaves, layers, layer_offsets):
+    """Pack octave indices, layers and layer offsets into OpenCV's KeyPoint.octave format
+    """
+    return (np.asarray(octaves, dtype=int) & 255) | (np.asarray(layers, dtype=int) << 8) | (np.asarray(layer_offsets, dtype=int) << 16)
+
 
-def unpackOctave(keypoint):
-    """Compute octave, layer, and scale from a keypoint
+def getGradientMaps(gradient_maps, gaussian_images, octave_index, image_index):
+    """Return the gradient maps of a Gaussian image, computing them only on first use of each (octave_index, image_index)
     """
-    octave = keypoint.octave & 255
-    layer = (keypoint.octave >> 8) & 255
-    if octave >= 128:
-        octave = octave | -128
-    scale = 1 / np.float32(1 << octave) if octave >= 0 else np.float32(1 << -octave)
-    return octave, layer, scale
+    key = (octave_index, image_index)
+    if key not in gradient_maps:
+        gradient_maps[key] = computeGradientMaps(gaussian_images[octave_index][image_index])
+    return gradient_maps[key]
 
 
-def generateDescriptors(keypoints, gaussian_images, window_width=4, num_bins=8, scale_multiplier=3, descriptor_max_value=0.2):
+def generateDescriptors(keypoints, gaussian_images, window_width=4, num_bins=8, scale_multiplier=3, descriptor_max_value=0.2, gradient_maps=None):
     """Generate descriptors for each keypoint
     """
-    descriptors = []
+    descriptors = np.zeros((len(keypoints), window_width * window_width * num_bins), dtype='float32')
+    if len(keypoints) == 0:
+        return descriptors
+    if gradient_maps is None:
+        gradient_maps = {}
+
+    scales = computeOctaveScales(keypoints.octave)
+    points = keypoints.points.astype('float64')
+    sizes = keypoints.size.astype('float64')
+    angles = keypoints.angle.astype('float64')
+
+    # keypoints of the same (octave, layer) share the gradient maps of their Gaussian image
+    for octave, layer, keypoint_indices in groupKeypointsByLayer(keypoints):
+        descriptors[keypoint_indices] = computeDescriptorsForKeypoints(
+            points[keypoint_indices], sizes[keypoint_indices], angles[keypoint_indices], scales[keypoint_indices],
+            getGradientMaps(gradient_maps, gaussian_images, octave + 1, layer), window_width, num_bins, scale_multiplier, descriptor_max_value)
+    return descriptors
+
+
+def computeDescriptorsForKeypoints(points, sizes, angles, scales, gradient_maps, window_width=4, num_bins=8, scale_multiplier=3, descriptor_max_value=0.2, max_samples_per_batch=2 ** 18):
+    """Generate descriptors for keypoints of the same Gaussian image, given as arrays of points, sizes, angles and scales, from the image's gradient maps
+    """
+    gradient_magnitude, gradient_orientation = gradient_maps
+    num_rows, num_cols = gradient_magnitude.shape
+    histogram_width = window_width + 2
+    bins_per_degree = num_bins / 360.
+    points = np.round(scales[:, np.newaxis] * points).astype(int)
+    angles = 360. - angles
+    cos_angles = np.cos(np.deg2rad(angles))
+    sin_angles = np.sin(np.deg2rad(angles))
+    weight_multiplier = -0.5 / ((0.5 * window_width) ** 2)
+    # first two dimensions are increased by 2 to account for border effects
+    histogram_tensors = np.zeros((len(points), histogram_width, histogram_width, num_bins))
+
+    # Descriptor window size (described by half_width) follows OpenCV convention
+    hist_widths = scale_multiplier * 0.5 * scales * sizes
+    # np.sqrt(2) corresponds to diagonal length of a pixel
+    half_widths = np.round(hist_widths * np.sqrt(2) * (window_width + 1) * 0.5).astype(int)
+    # ensure half_width lies within image
+    half_widths = np.minimum(half_widths, np.sqrt(num_rows ** 2 + num_cols ** 2)).astype(int)
+
+    # keypoints sharing a half width share the same sample grid; batches keep the per-sample arrays bounded
+    for half_width in np.unique(half_widths).tolist():
+        rows, cols = np.meshgrid(np.arange(-half_width, half_width + 1), np.arange(-half_width, half_width + 1), indexing='ij')
+        rows, cols = rows.ravel(), cols.ravel()
+        group_indices = np.nonzero(half_widths == half_width)[0]
+        batch_size = max(1, max_samples_per_batch // len(rows))
+        for batch_start in range(0, len(group_indices), batch_size):
+            keypoint_indices = group_indices[batch_start:batch_start + batch_size]
+            hist_width = hist_widths[keypoint_indices, np.newaxis]
+            row_rot = cols * sin_angles[keypoint_indices, np.newaxis] + rows * cos_angles[keypoint_indices, np.newaxis]
+            col_rot = cols * cos_angles[keypoint_indices, np.newaxis] - rows * sin_angles[keypoint_indices, np.newaxis]
+            row_bins = (row_rot / hist_width) + 0.5 * window_width - 0.5
+            col_bins = (col_rot / hist_width) + 0.5 * window_width - 0.5
+            window_rows = points[keypoint_indices, 1, np.newaxis] + rows
+            window_cols = points[keypoint_indices, 0, np.newaxis] + cols
+            is_sampled = (row_bins > -1) & (row_bins < window_width) & (col_bins > -1) & (col_bins < window_width) & \
+                (window_rows > 0) & (window_rows < num_rows - 1) & (window_cols > 0) & (window_cols < num_cols - 1)
+
+            # row-major masking keeps the sample order of the per-pixel loop, so the accumulated sums are identical
+            tensor_indices = np.broadcast_to(np.arange(len(keypoint_indices))[:, np.newaxis], is_sampled.shape)[is_sampled]
+            window_rows, window_cols = window_rows[is_sampled], window_cols[is_sampled]
+            row_rot, col_rot = row_rot[is_sampled], col_rot[is_sampled]
+            hist_width = np.broadcast_to(hist_width, is_sampled.shape)[is_sampled]
+            weights = np.exp(weight_multiplier * ((row_rot / hist_width) ** 2 + (col_rot / hist_width) ** 2))
+            magnitudes = weights * gradient_magnitude[window_rows, window_cols]
+            orientation_bins = (gradient_orientation[window_rows, window_cols].astype('float64') % 360 -
+                                np.broadcast_to(angles[keypoint_indices, np.newaxis], is_sampled.shape)[is_sampled]) * bins_per_degree
+            row_bins, col_bins = row_bins[is_sampled], col_bins[is_sampled]
 
-    for keypoint in keypoints:
-        octave, layer, scale = unpackOctave(keypoint)
-        gaussian_image = gaussian_images[octave + 1, layer]
-        num_rows, num_cols = gaussian_image.shape
-        point = np.round(scale * np.array(keypoint.pt)).astype('int')
-        bins_per_degree = num_bins / 360.
-        angle = 360. - keypoint.angle
-        cos_angle = np.cos(np.deg2rad(angle))
-        sin_angle = np.sin(np.deg2rad(angle))
-        weight_multiplier = -0.5 / ((0.5 * window_width) ** 2)
-        row_bin_list = []
-        col_bin_list = []
-        magnitude_list = []
-        orientation_bin_list = []
-        # first two dimensions are increased by 2 to account for border effects
-        histogram_tensor = np.zeros(
-            (window_width + 2, window_width + 2, num_bins))
-
-        # Descriptor window size (described by half_width) follows OpenCV convention
-        hist_width = scale_multiplier * 0.5 * scale * keypoint.size
-        # np.sqrt(2) corresponds to diagonal length of a pixel
-        half_width = int(
-            round(hist_width * np.sqrt(2) * (window_width + 1) * 0.5))
-        # ensure half_width lies within image
-        half_width = int(min(half_width, np.sqrt(num_rows ** 2 + num_cols ** 2)))
-
-        for row in range(-half_width, half_width + 1):
-            for col in range(-half_width, half_width + 1):
-                row_rot = col * sin_angle + row * cos_angle
-                col_rot = col * cos_angle - row * sin_angle
-                row_bin = (row_rot / hist_width) + 0.5 * window_width - 0.5
-                col_bin = (col_rot / hist_width) + 0.5 * window_width - 0.5
-                if row_bin > -1 and row_bin < window_width and col_bin > -1 and col_bin < window_width:
-                    window_row = int(round(point[1] + row))
-                    window_col = int(round(point[0] + col))
-                    if window_row > 0 and window_row < num_rows - 1 and window_col > 0 and window_col < num_cols - 1:
-                        dx = gaussian_image[window_row, window_col + 1] - \
-                            gaussian_image[window_row, window_col - 1]
-                        dy = gaussian_image[window_row - 1, window_col] - \
-                            gaussian_image[window_row + 1, window_col]
-                        gradient_magnitude = np.sqrt(dx * dx + dy * dy)
-                        gradient_orientation = np.rad2deg(np.arctan2(dy, dx)) % 360
-                        weight = np.exp(
-                            weight_multiplier * ((row_rot / hist_width) ** 2 + (col_rot / hist_width) ** 2))
-                        row_bin_list.append(row_bin)
-                        col_bin_list.append(col_bin)
-                        magnitude_list.append(weight * gradient_magnitude)
-                        orientation_bin_list.append(
-                            (gradient_orientation - angle) * bins_per_degree)
-
-        for row_bin, col_bin, magnitude, orientation_bin in zip(row_bin_list, col_bin_list, magnitude_list, orientation_bin_list):
             # Smoothing via trilinear interpolation
             # Notations follows https://en.wikipedia.org/wiki/Trilinear_interpolation
-            # Note that we are renp.ally doing the inverse of trilinear interpolation here (we take the center value of the cube and distribute it among its eight neighbors)
-            row_bin_floor, col_bin_floor, orientation_bin_floor = np.floor(
-                [row_bin, col_bin, orientation_bin]).astype(int)
-            row_fraction, col_fraction, orientation_fraction = row_bin - \
-                row_bin_floor, col_bin - col_bin_floor, orientation_bin - orientation_bin_floor
-            if orientation_bin_floor < 0:
-                orientation_bin_floor += num_bins
-            if orientation_bin_floor >= num_bins:
-                orientation_bin_floor -= num_bins
-
-            c1 = magnitude * row_fraction
-            c0 = magnitude * (1 - row_fraction)
-            c11 = c1 * col_fraction
-            c10 = c1 * (1 - col_fraction)
-            c01 = c0 * col_fraction
-            c00 = c0 * (1 - col_fraction)
-            c111 = c11 * orientation_fraction
-            c110 = c11 * (1 - orientation_fraction)
-            c101 = c10 * orientation_fraction
-            c100 = c10 * (1 - orientation_fraction)
-            c011 = c01 * orientation_fraction
-            c010 = c01 * (1 - orientation_fraction)
-            c001 = c00 * orientation_fraction
-            c000 = c00 * (1 - orientation_fraction)
-
-            histogram_tensor[row_bin_floor + 1,
-                             col_bin_floor + 1, orientation_bin_floor] += c000
-            histogram_tensor[row_bin_floor + 1, col_bin_floor +
-                             1, (orientation_bin_floor + 1) % num_bins] += c001
-            histogram_tensor[row_bin_floor + 1,
-                             col_bin_floor + 2, orientation_bin_floor] += c010
-            histogram_tensor[row_bin_floor + 1, col_bin_floor +
-                             2, (orientation_bin_floor + 1) % num_bins] += c011
-            histogram_tensor[row_bin_floor + 2,
-                             col_bin_floor + 1, orientation_bin_floor] += c100
-            histogram_tensor[row_bin_floor + 2, col_bin_floor +
-                             1, (orientation_bin_floor + 1) % num_bins] += c101
-            histogram_tensor[row_bin_floor + 2,
-                             col_bin_floor + 2, orientation_bin_floor] += c110
-            histogram_tensor[row_bin_floor + 2, col_bin_floor +
-                             2, (orientation_bin_floor + 1) % num_bins] += c111
-
-        # Remove histogram borders
-        descriptor_vector = histogram_tensor[1:-1, 1:-1, :].flatten()
-        # Threshold and normalize descriptor_vector
-        threshold = np.linalg.norm(descriptor_vector) * descriptor_max_value
-        descriptor_vector[descriptor_vector > threshold] = threshold
-        descriptor_vector /= max(np.linalg.norm(descriptor_vector), float_tolerance)
-        # Multiply by 512, round, and saturate between 0 and 255 to convert from np.float32 to unsigned char (OpenCV convention)
-        descriptor_vector = np.round(512 * descriptor_vector)
-        descriptor_vector[descriptor_vector < 0] = 0
-        descriptor_vector[descriptor_vector > 255] = 255
-        descriptors.append(descriptor_vector)
-    return np.array(descriptors, dtype='float32')
+            # Note that we are really doing the inverse of trilinear interpolation here (we take the center value of the cube and distribute it among its eight neighbors)
+            row_bin_floors = np.floor(row_bins).astype(int)
+            col_bin_floors = np.floor(col_bins).astype(int)
+            orientation_bin_floors = np.floor(orientation_bins).astype(int)
+            row_fractions = row_bins - row_bin_floors
+            col_fractions = col_bins - col_bin_floors
+            orientation_fractions = orientation_bins - orientation_bin_floors
+            orientation_bin_floors[orientation_bin_floors < 0] += num_bins
+            orientation_bin_floors[orientation_bin_floors >= num_bins] -= num_bins
+
+            c1 = magnitudes * row_fractions
+            c0 = magnitudes * (1 - row_fractions)
+            c11 = c1 * col_fractions
+            c10 = c1 * (1 - col_fractions)
+            c01 = c0 * col_fractions
+            c00 = c0 * (1 - col_fractions)
+            corner_weights = np.stack([c00 * (1 - orientation_fractions), c00 * orientation_fractions,
+                                       c01 * (1 - orientation_fractions), c01 * orientation_fractions,
+                                       c10 * (1 - orientation_fractions), c10 * orientation_fractions,
+                                       c11 * (1 - orientation_fractions), c11 * orientation_fractions], axis=1)
+            next_orientation_bin_floors = (orientation_bin_floors + 1) % num_bins
+            cell_indices = (tensor_indices * histogram_width + row_bin_floors + 1) * histogram_width + col_bin_floors + 1
+            corner_indices = np.stack([cell_indices * num_bins + orientation_bin_floors, cell_indices * num_bins + next_orientation_bin_floors,
+                                       (cell_indices + 1) * num_bins + orientation_bin_floors, (cell_indices + 1) * num_bins + next_orientation_bin_floors,
+                                       (cell_indices + histogram_width) * num_bins + orientation_bin_floors, (cell_indices + histogram_width) * num_bins + next_orientation_bin_floors,
+                                       (cell_indices + histogram_width + 1) * num_bins + orientation_bin_floors, (cell_indices + histogram_width + 1) * num_bins + next_orientation_bin_floors], axis=1)
+            # the eight corners of one sample always fall in distinct bins, so each bin is summed in sample order
+            histogram_tensors[keypoint_indices] = np.bincount(corner_indices.ravel(), weights=corner_weights.ravel(),
+                                                              minlength=len(keypoint_indices) * histogram_width * histogram_width * num_bins
+                                                              ).reshape(-1, histogram_width, histogram_width, num_bins)
+
+    # Remove histogram borders
+    descriptor_vectors = histogram_tensors[:, 1:-1, 1:-1, :].reshape(len(points), -1)
+    # Threshold and normalize descriptor_vectors; the norms are computed with the same dot product as np.linalg.norm of each row
+    thresholds = np.sqrt(np.matmul(descriptor_vectors[:, np.newaxis, :], descriptor_vectors[:, :, np.newaxis])[:, 0, 0]) * descriptor_max_value
+    descriptor_vectors = np.minimum(descriptor_vectors, thresholds[:, np.newaxis])
+    norms = np.sqrt(np.matmul(descriptor_vectors[:, np.newaxis, :], descriptor_vectors[:, :, np.newaxis])[:, 0, 0])
+    descriptor_vectors /= np.maximum(norms, float_tolerance)[:, np.newaxis]
+    # Multiply by 512, round, and saturate between 0 and 255 to convert from np.float32 to unsigned char (OpenCV convention)
+    descriptor_vectors = np.clip(np.round(512 * descriptor_vectors), 0, 255)
+    return descriptor_vectors.astype('float32')
 
 
 #  Testing Code
@@ -452,7 +1419,7 @@ def generateDescriptors(keypoints, gaussian_images, window_width=4, num_bins=8,
 # keypoints, descriptors = computeKeypointsAndDescriptors(image)
 
 # # Visualize keypoints (optional)
-# image_with_keypoints = cv2.drawKeypoints(image, keypoints, None)
+# image_with_keypoints = cv2.drawKeypoints(image, keypoints.toKeyPoints(), None)
 # cv2.imshow('Keypoints', image_with_keypoints)
 # cv2.waitKey(0)
 # cv2.destroyAllWindows()
\ No newline at end of file